@@ -1,10 +1,24 @@
 #coding=utf-8
 
 import struct, time, os, zlib, io, shutil, sys, getopt, gzip, json, copy
+import concurrent.futures, mmap, sqlite3, hashlib, collections, cProfile, csv, threading
+import numpy
 from nbt import nbt
 
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 class RegionList: # {{{
 
+    UNBOUNDED = 1 << 40
+
     @staticmethod
     def match_range(left, right): # {{{
         if len(left) < 2:
@@ -46,6 +60,13 @@ class RegionList: # {{{
         return ret
     # }}}
 
+    @staticmethod
+    def bound_range(data): # {{{
+        if len(data) < 2:
+            return [-RegionList.UNBOUNDED, RegionList.UNBOUNDED]
+        return data
+    # }}}
+
     def add_region(self, region, div = False): # {{{
         tmp = {}
         tmp['type'] = region['type']
@@ -58,10 +79,24 @@ class RegionList: # {{{
         else:
             tmp['z'] = []
         self.area.append(tmp)
+        self.bounds = None
     # }}}
 
     def __init__(self): # {{{
         self.area = []
+        self.bounds = None
+        self.include = None
+    # }}}
+
+    def compile(self): # {{{
+        if self.bounds is None:
+            self.bounds = numpy.zeros((len(self.area), 4), dtype=numpy.int64)
+            self.include = numpy.zeros(len(self.area), dtype=bool)
+            for i, region in enumerate(self.area):
+                self.bounds[i, 0:2] = RegionList.bound_range(region['x'])
+                self.bounds[i, 2:4] = RegionList.bound_range(region['z'])
+                self.include[i] = region['type'] == 'include'
+        return (self.bounds, self.include)
     # }}}
 
     def __repr__(self): # {{{
@@ -81,40 +116,564 @@ class RegionList: # {{{
     # }}}
 
     def match(self, to_match): # {{{
-        ret_list = []
-        for region in self.area:
-            item = RegionList.match_region(region, to_match)
-            if item != None:
-                ret_list.append(item)
-        if len(ret_list) <= 0:
+        bounds, include = self.compile()
+        x = RegionList.bound_range(to_match['x'])
+        z = RegionList.bound_range(to_match['z'])
+        clipped = numpy.empty_like(bounds)
+        clipped[:, 0] = numpy.maximum(bounds[:, 0], x[0])
+        clipped[:, 1] = numpy.minimum(bounds[:, 1], x[1])
+        clipped[:, 2] = numpy.maximum(bounds[:, 2], z[0])
+        clipped[:, 3] = numpy.minimum(bounds[:, 3], z[1])
+        hit = (clipped[:, 0] <= clipped[:, 1]) & (clipped[:, 2] <= clipped[:, 3])
+        if not hit.any():
             return None
+
         region_list = RegionList()
-        region_list.add(region_list = ret_list)
+        region_list.bounds = clipped[hit]
+        region_list.include = include[hit]
+        for i, item in enumerate(region_list.bounds.tolist()):
+            rtype = 'exclude'
+            if region_list.include[i]:
+                rtype = 'include'
+            region_list.area.append({'type': rtype, 'x': item[0:2], 'z': item[2:4]})
         return region_list
     # }}}
 
+    def mask(self, base): # {{{
+        bounds, include = self.compile()
+        grid = numpy.zeros((32, 32), dtype=bool)
+        x0 = numpy.clip(bounds[:, 0] - base[0], 0, 32).tolist()
+        x1 = numpy.clip(bounds[:, 1] - base[0] + 1, 0, 32).tolist()
+        z0 = numpy.clip(bounds[:, 2] - base[1], 0, 32).tolist()
+        z1 = numpy.clip(bounds[:, 3] - base[1] + 1, 0, 32).tolist()
+        for i, rtype in enumerate(include.tolist()):
+            grid[z0[i]:z1[i], x0[i]:x1[i]] = rtype
+        return grid.reshape(1024)
+    # }}}
+
+    def contains(self, x, z): # {{{
+        bounds, include = self.compile()
+        ret = numpy.zeros(len(x), dtype=bool)
+        for i, rtype in enumerate(include.tolist()):
+            ret[(x >= bounds[i, 0]) & (x <= bounds[i, 1]) & (z >= bounds[i, 2]) & (z <= bounds[i, 3])] = rtype
+        return ret
+    # }}}
+
     def apply(self, base, chunks): # {{{
-        for region in self.area:
-            x_range = [region['x'][0] - base[0], region['x'][1] - base[0]]
-            z_range = [region['z'][0] - base[0], region['z'][1] - base[0]]
-            rtype = region['type']
-            for x in range(x_range[0], x_range[1] + 1):
-                for z in range(z_range[0], z_range[1] + 1):
-                    if rtype == 'include':
-                        chunks[x + z * 32] = 1
-                    else:
-                        chunks[x + z * 32] = 0
+        grid = self.mask(base)
+        for i in numpy.flatnonzero(grid != numpy.array(chunks, dtype=bool)).tolist():
+            if grid[i]:
+                chunks[i] = 1
+            else:
+                chunks[i] = 0
+    # }}}
+
+    def get_files(self, limit = 4096): # {{{
+        bounds, include = self.compile()
+        bounds = bounds[include]
+        if (numpy.abs(bounds) >= RegionList.UNBOUNDED).any():
+            return None
+        bounds = bounds // 32
+        if int(((bounds[:, 1] - bounds[:, 0] + 1) * (bounds[:, 3] - bounds[:, 2] + 1)).sum()) > limit:
+            return None
+
+        files = set()
+        for x0, x1, z0, z1 in bounds.tolist():
+            for x in range(x0, x1 + 1):
+                for z in range(z0, z1 + 1):
+                    files.add('r.%d.%d.mca' % (x, z))
+        return files
+    # }}}
+
+# }}}
+
+class Profile: # {{{
+
+    enabled = False
+    stages = {}
+    counters = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def start(): # {{{
+        if not Profile.enabled:
+            return None
+        return (time.perf_counter(), time.thread_time())
+    # }}}
+
+    @staticmethod
+    def stop(stage, start): # {{{
+        if start == None:
+            return
+        wall = time.perf_counter() - start[0]
+        cpu = time.thread_time() - start[1]
+        with Profile.lock:
+            if not stage in Profile.stages:
+                Profile.stages[stage] = [0, 0.0, 0.0]
+            item = Profile.stages[stage]
+            item[0] += 1
+            item[1] += wall
+            item[2] += cpu
+    # }}}
+
+    @staticmethod
+    def add(name, value = 1): # {{{
+        if not Profile.enabled:
+            return
+        with Profile.lock:
+            if name in Profile.counters:
+                Profile.counters[name] += value
+            else:
+                Profile.counters[name] = value
+    # }}}
+
+    @staticmethod
+    def reset(): # {{{
+        Profile.stages = {}
+        Profile.counters = {}
+    # }}}
+
+    @staticmethod
+    def snapshot(): # {{{
+        with Profile.lock:
+            return {'stages': copy.deepcopy(Profile.stages), 'counters': dict(Profile.counters)}
+    # }}}
+
+    @staticmethod
+    def merge(snapshot): # {{{
+        with Profile.lock:
+            for stage in snapshot['stages']:
+                count, wall, cpu = snapshot['stages'][stage]
+                if not stage in Profile.stages:
+                    Profile.stages[stage] = [0, 0.0, 0.0]
+                item = Profile.stages[stage]
+                item[0] += count
+                item[1] += wall
+                item[2] += cpu
+        for name in snapshot['counters']:
+            Profile.add(name, snapshot['counters'][name])
+    # }}}
+
+    @staticmethod
+    def report(out_file, wall): # {{{
+        print('总耗时: %.3fs' % wall, file=out_file)
+        print('%-12s %10s %12s %12s' % ('阶段', '次数', '墙钟(s)', 'CPU(s)'), file=out_file)
+        for stage in sorted(Profile.stages):
+            count, stage_wall, cpu = Profile.stages[stage]
+            print('%-12s %10d %12.3f %12.3f' % (stage, count, stage_wall, cpu), file=out_file)
+        for name in sorted(Profile.counters):
+            print('%-20s %s' % (name, format(Profile.counters[name], ',')), file=out_file)
+    # }}}
+
+# }}}
+
+class NbtScanner: # {{{
+
+    TAG_END = 0
+    TAG_LIST = 9
+    TAG_COMPOUND = 10
+
+    FORMATS = {1: '>b', 2: '>h', 3: '>i', 4: '>q', 5: '>f', 6: '>d'}
+    SIZES = {1: 1, 2: 2, 3: 4, 4: 8, 5: 4, 6: 8}
+    ARRAYS = {7: 1, 11: 4, 12: 8}
+
+    def __init__(self, data): # {{{
+        self.data = memoryview(data)
+    # }}}
+
+    def read_name(self, pos): # {{{
+        length, = struct.unpack_from('>H', self.data, pos)
+        name = bytes(self.data[pos + 2:pos + 2 + length]).decode('utf-8', 'replace')
+        return (name, pos + 2 + length)
+    # }}}
+
+    def skip(self, tag_type, pos): # {{{
+        if tag_type in NbtScanner.SIZES:
+            return pos + NbtScanner.SIZES[tag_type]
+        if tag_type in NbtScanner.ARRAYS:
+            length, = struct.unpack_from('>i', self.data, pos)
+            return pos + 4 + length * NbtScanner.ARRAYS[tag_type]
+        if tag_type == 8:
+            length, = struct.unpack_from('>H', self.data, pos)
+            return pos + 2 + length
+        if tag_type == NbtScanner.TAG_LIST:
+            elem_type = self.data[pos]
+            length, = struct.unpack_from('>i', self.data, pos + 1)
+            pos += 5
+            if elem_type in NbtScanner.SIZES:
+                return pos + length * NbtScanner.SIZES[elem_type]
+            for i in range(0, length):
+                pos = self.skip(elem_type, pos)
+            return pos
+        if tag_type == NbtScanner.TAG_COMPOUND:
+            while True:
+                item_type = self.data[pos]
+                if item_type == NbtScanner.TAG_END:
+                    return pos + 1
+                length, = struct.unpack_from('>H', self.data, pos + 1)
+                pos = self.skip(item_type, pos + 3 + length)
+        raise ValueError('tag type %d' % tag_type)
+    # }}}
+
+    def items(self, pos): # {{{
+        while True:
+            item_type = self.data[pos]
+            if item_type == NbtScanner.TAG_END:
+                return
+            name, pos = self.read_name(pos + 1)
+            yield (item_type, name, pos)
+            pos = self.skip(item_type, pos)
+    # }}}
+
+    def elements(self, pos): # {{{
+        elem_type = self.data[pos]
+        length, = struct.unpack_from('>i', self.data, pos + 1)
+        pos += 5
+        for i in range(0, length):
+            yield (elem_type, pos)
+            pos = self.skip(elem_type, pos)
+    # }}}
+
+    def value(self, tag_type, pos): # {{{
+        if tag_type in NbtScanner.FORMATS:
+            return struct.unpack_from(NbtScanner.FORMATS[tag_type], self.data, pos)[0]
+        if tag_type in NbtScanner.ARRAYS:
+            length, = struct.unpack_from('>i', self.data, pos)
+            return self.data[pos + 4:pos + 4 + length * NbtScanner.ARRAYS[tag_type]]
+        if tag_type == 8:
+            return self.read_name(pos)[0]
+        return pos
+    # }}}
+
+    def root(self): # {{{
+        tag_type = self.data[0]
+        name, pos = self.read_name(1)
+        return (tag_type, name, pos)
+    # }}}
+
+    def find(self, path): # {{{
+        tag_type, name, pos = self.root()
+        for key in [i for i in path.split('/') if i != '']:
+            found = None
+            if tag_type == NbtScanner.TAG_COMPOUND:
+                for item_type, item_name, item_pos in self.items(pos):
+                    if item_name == key:
+                        found = (item_type, item_name, item_pos)
+                        break
+            elif tag_type == NbtScanner.TAG_LIST and key.isdigit():
+                for i, (elem_type, elem_pos) in enumerate(self.elements(pos)):
+                    if i == int(key):
+                        found = (elem_type, None, elem_pos)
+                        break
+            if found == None:
+                return None
+            tag_type, name, pos = found
+        return (tag_type, name, pos)
+    # }}}
+
+    def compound(self, pos, names): # {{{
+        ret = {}
+        for item_type, name, item_pos in self.items(pos):
+            if name in names:
+                ret[name] = self.value(item_type, item_pos)
+        return ret
+    # }}}
+
+    def palette(self, tag_type, pos): # {{{
+        if tag_type != NbtScanner.TAG_LIST or self.data[pos] != NbtScanner.TAG_COMPOUND:
+            return []
+        return [self.compound(elem_pos, ('Name',)).get('Name', '') for elem_type, elem_pos in self.elements(pos)]
+    # }}}
+
+    def section(self, pos): # {{{
+        ret = {}
+        for item_type, name, item_pos in self.items(pos):
+            if name in ('Y', 'Blocks', 'Add', 'Data', 'BlockStates'):
+                ret[name] = self.value(item_type, item_pos)
+            elif name == 'Palette':
+                ret['Palette'] = self.palette(item_type, item_pos)
+            elif name == 'block_states' and item_type == NbtScanner.TAG_COMPOUND:
+                for state_type, state_name, state_pos in self.items(item_pos):
+                    if state_name == 'palette':
+                        ret['Palette'] = self.palette(state_type, state_pos)
+                    elif state_name == 'data':
+                        ret['BlockStates'] = self.value(state_type, state_pos)
+        return ret
+    # }}}
+
+    def sections(self): # {{{
+        found = self.find('Level/Sections')
+        if found == None:
+            found = self.find('sections')
+        if found == None:
+            return []
+        tag_type, name, pos = found
+        if tag_type != NbtScanner.TAG_LIST or self.data[pos] != NbtScanner.TAG_COMPOUND:
+            return []
+        return [self.section(elem_pos) for elem_type, elem_pos in self.elements(pos)]
+    # }}}
+
+    def write_json(self, out_file, tag_type, pos): # {{{
+        if tag_type in (5, 6):
+            value = self.value(tag_type, pos)
+            out_file.write(repr(value) if value == value and abs(value) != float('inf') else 'null')
+        elif tag_type in NbtScanner.FORMATS:
+            out_file.write(str(self.value(tag_type, pos)))
+        elif tag_type == 8:
+            out_file.write(json.dumps(self.value(tag_type, pos), ensure_ascii = False))
+        elif tag_type in NbtScanner.ARRAYS:
+            size = NbtScanner.ARRAYS[tag_type]
+            values = numpy.frombuffer(self.value(tag_type, pos), dtype = '>i%d' % size)
+            out_file.write('[')
+            for i in range(0, len(values), 4096):
+                if i > 0:
+                    out_file.write(',')
+                out_file.write(','.join(map(str, values[i:i + 4096].tolist())))
+            out_file.write(']')
+        elif tag_type == NbtScanner.TAG_LIST:
+            out_file.write('[')
+            for i, (elem_type, elem_pos) in enumerate(self.elements(pos)):
+                if i > 0:
+                    out_file.write(',')
+                self.write_json(out_file, elem_type, elem_pos)
+            out_file.write(']')
+        elif tag_type == NbtScanner.TAG_COMPOUND:
+            out_file.write('{')
+            for i, (item_type, name, item_pos) in enumerate(self.items(pos)):
+                if i > 0:
+                    out_file.write(',')
+                out_file.write(json.dumps(name, ensure_ascii = False))
+                out_file.write(':')
+                self.write_json(out_file, item_type, item_pos)
+            out_file.write('}')
+        else:
+            raise ValueError('tag type %d' % tag_type)
+    # }}}
+
+    def dump_json(self, out_file, path = None): # {{{
+        found = self.find(path or '')
+        if found == None:
+            return False
+        tag_type, name, pos = found
+        self.write_json(out_file, tag_type, pos)
+        out_file.write('\n')
+        return True
+    # }}}
+
+    def get_tag(self, path): # {{{
+        found = self.find(path)
+        if found == None:
+            return None
+        tag_type, name, pos = found
+        end = self.skip(tag_type, pos)
+        tmp_file = io.BytesIO(self.data[pos:end])
+        try:
+            return nbt.TAGLIST[tag_type](name = name, buffer = tmp_file)
+        finally:
+            tmp_file.close()
     # }}}
 
 # }}}
 
 class McChunk: # {{{
 
+    COMPRESS = {'gzip': 1, 'zlib': 2, 'none': 3, 'lz4': 4}
+    LEVELS = {'gzip': (0, 9), 'zlib': (-1, 9), 'none': None, 'lz4': (0, 12)}
+    LZ4_MAGIC = b'LZ4Block'
+    LZ4_SEED = 0x9747b28c
+    LZ4_BLOCK = 1 << 16
+    AIR = ('minecraft:air', 'minecraft:cave_air', 'minecraft:void_air')
+
+    @staticmethod
+    def decode(data, external = None): # {{{
+        compress = data[0] & 0x7F
+        payload = data[1:]
+        if data[0] & 0x80:
+            if external == None:
+                raise Exception('外部区块文件不存在')
+            payload = external
+        if compress == 1:
+            return gzip.decompress(payload)
+        elif compress == 2:
+            return zlib.decompress(payload)
+        elif compress == 3:
+            return bytes(payload)
+        elif compress == 4:
+            return McChunk.lz4_decode(payload)
+        raise Exception('未知的压缩格式: %d' % compress)
+    # }}}
+
+    @staticmethod
+    def encode(raw, compress = 'zlib', level = None): # {{{
+        if compress == 'gzip':
+            return b'\x01' + gzip.compress(raw, compresslevel = 6 if level == None else level, mtime = 0)
+        elif compress == 'zlib':
+            return b'\x02' + zlib.compress(raw, -1 if level == None else level)
+        elif compress == 'none':
+            return b'\x03' + bytes(raw)
+        elif compress == 'lz4':
+            return b'\x04' + McChunk.lz4_encode(raw, level)
+        raise Exception('未知的压缩格式: %s' % compress)
+    # }}}
+
+    @staticmethod
+    def check_level(compress, level): # {{{
+        levels = McChunk.LEVELS[compress]
+        return levels != None and levels[0] <= level <= levels[1]
+    # }}}
+
+    @staticmethod
+    def lz4_decode(data): # {{{
+        if lz4 == None:
+            raise Exception('缺少lz4模块')
+        ret = []
+        pos = 0
+        while pos + 21 <= len(data):
+            if bytes(data[pos:pos + 8]) != McChunk.LZ4_MAGIC:
+                raise Exception('LZ4数据错误')
+            token = data[pos + 8]
+            size, raw_size, check = struct.unpack_from('<iii', data, pos + 9)
+            pos += 21
+            if raw_size == 0:
+                break
+            if token & 0xF0 == 0x10:
+                ret.append(bytes(data[pos:pos + size]))
+            else:
+                ret.append(lz4.block.decompress(bytes(data[pos:pos + size]), uncompressed_size = raw_size))
+            pos += size
+        return b''.join(ret)
+    # }}}
+
+    @staticmethod
+    def lz4_encode(raw, level = None): # {{{
+        if lz4 == None or xxhash == None:
+            raise Exception('缺少lz4或xxhash模块')
+        ret = []
+        token = (McChunk.LZ4_BLOCK - 1).bit_length() - 10
+        for pos in range(0, len(raw), McChunk.LZ4_BLOCK):
+            block = bytes(raw[pos:pos + McChunk.LZ4_BLOCK])
+            if level == None or level <= 0:
+                data = lz4.block.compress(block, store_size = False)
+            else:
+                data = lz4.block.compress(block, mode = 'high_compression', compression = level, store_size = False)
+            method = 0x20
+            if len(data) >= len(block):
+                data = block
+                method = 0x10
+            check = xxhash.xxh32_intdigest(block, McChunk.LZ4_SEED) & 0x0FFFFFFF
+            ret.append(McChunk.LZ4_MAGIC + struct.pack('<Biii', method | token, len(data), len(block), check) + data)
+        ret.append(McChunk.LZ4_MAGIC + struct.pack('<Biii', 0x10 | token, 0, 0, 0))
+        return b''.join(ret)
+    # }}}
+
+    @staticmethod
+    def block_name(name): # {{{
+        if name.find(':') == -1:
+            return 'minecraft:' + name
+        return name
+    # }}}
+
+    @staticmethod
+    def compile_calc(calc): # {{{
+        names = list(calc)
+        matrix = numpy.zeros((len(names), 4096), dtype=numpy.int64)
+        exclude = numpy.zeros(len(names), dtype=bool)
+        blocks = {}
+        for i, name in enumerate(names):
+            if 'include' in calc[name]:
+                ids = calc[name]['include']
+            elif 'exclude' in calc[name]:
+                ids = calc[name]['exclude']
+                exclude[i] = True
+            else:
+                continue
+            for bid in ids:
+                if isinstance(bid, str):
+                    bid = McChunk.block_name(bid)
+                    if not bid in blocks:
+                        blocks[bid] = numpy.zeros(len(names), dtype=numpy.int64)
+                    blocks[bid][i] = 1
+                elif 0 <= bid < 4096:
+                    matrix[i, bid] = 1
+        return (names, matrix, exclude, blocks)
+    # }}}
+
+    @staticmethod
+    def count_rules(rules, hist, block_sum, block_names = None): # {{{
+        names, matrix, exclude, blocks = rules
+        count = matrix.dot(hist)
+        if block_names != None:
+            for name in block_names:
+                if name in blocks:
+                    count += blocks[name] * block_names[name]
+        count[exclude] = block_sum - count[exclude]
+        return dict(zip(names, count.tolist()))
+    # }}}
+
+    @staticmethod
+    def palette_ids(states, size): # {{{
+        if states == None or len(states) == 0 or size <= 1:
+            return numpy.zeros(4096, dtype=numpy.uint16)
+
+        bits = max(4, (size - 1).bit_length())
+        mask = numpy.uint64((1 << bits) - 1)
+        longs = numpy.frombuffer(states, dtype='>u8').astype(numpy.uint64)
+        per_long = 64 // bits
+        if len(longs) == (4096 + per_long - 1) // per_long:
+            shifts = numpy.arange(per_long, dtype=numpy.uint64) * numpy.uint64(bits)
+            ids = ((longs[:, None] >> shifts) & mask).reshape(-1)[:4096]
+        else:
+            pos = numpy.arange(4096, dtype=numpy.uint64) * numpy.uint64(bits)
+            index = (pos >> numpy.uint64(6)).astype(numpy.intp)
+            offset = pos & numpy.uint64(63)
+            ids = longs[index] >> offset
+            spill = offset + numpy.uint64(bits) > numpy.uint64(64)
+            if spill.any():
+                high = longs[numpy.minimum(index[spill] + 1, len(longs) - 1)]
+                ids[spill] |= high << (numpy.uint64(64) - offset[spill])
+            ids &= mask
+        return ids.astype(numpy.uint16)
+    # }}}
+
+    @staticmethod
+    def clip_sections(sections, y): # {{{
+        for section in sections:
+            if not 'Y' in section or not ('Blocks' in section or 'Palette' in section):
+                continue
+            cy = section['Y']
+            cy_range = [cy * 16, cy * 16 + 15]
+            cy_range = RegionList.match_range(y, cy_range)
+            if cy_range == None:
+                continue
+            yield (section, cy_range[0], cy_range[0] - cy * 16, cy_range[1] + 1 - cy * 16)
+    # }}}
+
+    @staticmethod
+    def get_ids(section): # {{{
+        if 'Blocks' in section:
+            add = None
+            if 'Add' in section:
+                add = section['Add']
+            return (McChunk.section_ids(section['Blocks'], add), None)
+        palette = section['Palette']
+        return (McChunk.palette_ids(section.get('BlockStates'), len(palette)), palette)
+    # }}}
+
+    @staticmethod
+    def nibbles(data): # {{{
+        data = numpy.frombuffer(data, dtype=numpy.uint8)
+        ret = numpy.empty(len(data) * 2, dtype=numpy.uint16)
+        ret[0::2] = data & 0x0F
+        ret[1::2] = data >> 4
+        return ret
+    # }}}
+
     @staticmethod
-    def count(blist, bid, cache): # {{{
-        if not bid in cache:
-            cache[bid] = blist.count(bid)
-        return cache[bid]
+    def section_ids(blocks, add = None): # {{{
+        ids = numpy.frombuffer(blocks, dtype=numpy.uint8)
+        if add == None:
+            return ids
+        return ids | (McChunk.nibbles(add) << 8)
     # }}}
 
     def __init(self): # {{{
@@ -144,6 +703,38 @@ class McChunk: # {{{
 
     def set_data(self, data): # {{{
         self.data = data
+        self.raw = None
+        self.external = None
+        self.external_path = None
+    # }}}
+
+    def set_external(self, path): # {{{
+        self.external_path = path
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > 0:
+                    self.external = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                else:
+                    self.external = b''
+        except OSError as e:
+            self.external = None
+        if self.external != None:
+            Profile.add('bytes_read', len(self.external))
+            Profile.add('chunks_external')
+    # }}}
+
+    def get_size(self): # {{{
+        if getattr(self, 'external', None) != None:
+            return len(self.data) + len(self.external)
+        return len(self.data)
+    # }}}
+
+    def is_external(self): # {{{
+        return len(self.data) > 0 and self.data[0] & 0x80 != 0
+    # }}}
+
+    def set_raw(self, raw): # {{{
+        self.raw = raw
     # }}}
 
     def pack_data(self): # {{{
@@ -155,8 +746,50 @@ class McChunk: # {{{
         self.file = file_path
     # }}}
 
-    def print_nbt(self, out_file): # {{{
-        nbtfile = McRegion.decode_nbt(self.data[1:], 'zlib')
+    def decompress(self): # {{{
+        if getattr(self, 'raw', None) != None:
+            return self.raw
+        start = Profile.start()
+        raw = McChunk.decode(self.data, getattr(self, 'external', None))
+        Profile.stop('decompress', start)
+        Profile.add('bytes_decompressed', len(raw))
+        return raw
+    # }}}
+
+    def recompress(self, compress, level = None, raw = None): # {{{
+        if raw == None:
+            raw = self.decompress()
+        start = Profile.start()
+        self.set_data(McChunk.encode(raw, compress, level))
+        Profile.stop('compress', start)
+        Profile.add('bytes_compressed', len(self.data))
+    # }}}
+
+    def get_sections(self): # {{{
+        raw = self.decompress()
+        start = Profile.start()
+        sections = NbtScanner(raw).sections()
+        Profile.stop('scan', start)
+        return sections
+    # }}}
+
+    def print_nbt(self, out_file, path = None): # {{{
+        if path != None:
+            try:
+                tag = NbtScanner(self.decompress()).get_tag(path)
+            except Exception as e:
+                print('区块数据错误')
+                return
+            if tag != None:
+                print(tag.pretty_tree(), file=out_file)
+            else:
+                print('路径不存在')
+            return
+
+        try:
+            nbtfile = McRegion.decode_nbt(self.decompress())
+        except Exception as e:
+            nbtfile = None
         if nbtfile != None:
             local_time = time.localtime(self.time_stamp)
             dt = time.strftime('%Y-%m-%d %H:%M:%S',local_time)
@@ -166,52 +799,164 @@ class McChunk: # {{{
             print('区块数据错误')
     # }}}
 
-    def calc_block(self, args): # {{{
-        nbtfile = McRegion.decode_nbt(self.data[1:], 'zlib')
-        if nbtfile == None:
+    def get_scalar(self, *paths): # {{{
+        scanner = NbtScanner(self.decompress())
+        for path in paths:
+            found = scanner.find(path)
+            if found != None and found[0] in NbtScanner.FORMATS:
+                return scanner.value(found[0], found[2])
+        return None
+    # }}}
+
+    def is_empty(self): # {{{
+        for section, row, low, high in McChunk.clip_sections(self.get_sections(), []):
+            ids, palette = McChunk.get_ids(section)
+            if palette == None:
+                if ids.any():
+                    return False
+                continue
+            for i in numpy.unique(ids).tolist():
+                if i < len(palette) and not palette[i] in McChunk.AIR:
+                    return False
+        return True
+    # }}}
+
+    def can_prune(self, prune): # {{{
+        start = Profile.start()
+        try:
+            if 'inhabited' in prune:
+                inhabited = self.get_scalar('Level/InhabitedTime', 'InhabitedTime')
+                if inhabited == None or inhabited >= prune['inhabited']:
+                    return False
+            if prune.get('empty') and not self.is_empty():
+                return False
+        except Exception as e:
+            Profile.add('chunks_corrupt')
+            return False
+        finally:
+            Profile.stop('prune', start)
+        return True
+    # }}}
+
+    def print_json(self, out_file, path = None): # {{{
+        try:
+            found = NbtScanner(self.decompress()).dump_json(out_file or sys.stdout, path)
+        except Exception as e:
             print('区块数据错误')
-            sys.exit()
+            return
+        if not found:
+            print('路径不存在')
+    # }}}
 
-        calc = {}
-        if 'calc' in args:
-            calc = args['calc']
-        y = [0, 255]
+    def calc_block(self, args): # {{{
+        try:
+            sections = self.get_sections()
+        except Exception as e:
+            Profile.add('chunks_corrupt')
+            return None
+
+        rules = None
+        if 'rules' in args:
+            rules = args['rules']
+        elif 'calc' in args:
+            rules = McChunk.compile_calc(args['calc'])
+        else:
+            rules = McChunk.compile_calc({})
+        y = []
         if 'y' in args:
             y = args['y']
 
-        ret = {}
-        for name in calc:
-            ret[name] = 0
-
-        sections = nbtfile['Level']['Sections']
-        for section in sections:
-            cy = section['Y'].value
-            cy_range = [cy * 16, cy * 16 + 15]
-            cy_range = RegionList.match_range(y, cy_range)
-            if cy_range == None:
+        start = Profile.start()
+        hist = numpy.zeros(4096, dtype=numpy.int64)
+        block_names = {}
+        block_sum = 0
+
+        for section, row, low, high in McChunk.clip_sections(sections, y):
+            ids, palette = McChunk.get_ids(section)
+            ids = ids[low * 256:high * 256]
+            block_sum += len(ids)
+            if palette == None:
+                section_hist = numpy.bincount(ids)
+                hist[:len(section_hist)] += section_hist
                 continue
-            cy_range = [cy_range[0] - cy * 16, cy_range[1] + 1 - cy * 16]
-
-            blocks = section['Blocks']
-            blocks = section['Blocks'][cy_range[0] * 256:cy_range[1] * 256]
-            block_sum = (cy_range[1] - cy_range[0]) * 256
-            cache = {}
-            for name in calc:
-                if 'include' in calc[name]:
-                    for bid in calc[name]['include']:
-                        ret[name] += McChunk.count(blocks, bid, cache)
-                elif 'exclude' in calc[name]:
-                    ncount = 0
-                    for bid in calc[name]['exclude']:
-                        ncount += McChunk.count(blocks, bid, cache)
-                    ret[name] += block_sum - ncount
+            section_hist = numpy.bincount(ids, minlength = len(palette))
+            for i, value in enumerate(section_hist[:len(palette)].tolist()):
+                if value > 0:
+                    block_names[palette[i]] = block_names.get(palette[i], 0) + value
+        count = McChunk.count_rules(rules, hist, block_sum, block_names)
+        Profile.stop('count', start)
+        return count
+    # }}}
+
+    @staticmethod
+    def hist_table(args): # {{{
+        if args['width'] > 4096:
+            return {}
+        return numpy.zeros((args['y'][1] - args['y'][0] + 1, args['width']), dtype=numpy.int64)
+    # }}}
+
+    @staticmethod
+    def dense_hist(table, args): # {{{
+        if not isinstance(table, dict):
+            return table
+        ret = numpy.zeros((args['y'][1] - args['y'][0] + 1, args['width']), dtype=numpy.int64)
+        if len(table) > 0:
+            ret.reshape(-1)[numpy.fromiter(table.keys(), dtype=numpy.int64, count = len(table))] = numpy.fromiter(table.values(), dtype=numpy.int64, count = len(table))
         return ret
     # }}}
 
+    def calc_hist(self, args, ret): # {{{
+        try:
+            sections = self.get_sections()
+        except Exception as e:
+            Profile.add('chunks_corrupt')
+            return False
+
+        start = Profile.start()
+        y = args['y']
+        table = ret['ids']
+        width = args['width']
+        for section, row, low, high in McChunk.clip_sections(sections, y):
+            row -= y[0]
+            rows = high - low
+            ids, palette = McChunk.get_ids(section)
+
+            if palette != None:
+                ids = ids[low * 256:high * 256].astype(numpy.intp)
+                ids += numpy.repeat(numpy.arange(rows, dtype=numpy.intp) * len(palette), 256)
+                counts = numpy.bincount(ids, minlength = rows * len(palette))[:rows * len(palette)]
+                counts = counts.reshape(rows, len(palette))
+                for i, name in enumerate(palette):
+                    if not name in ret['names']:
+                        ret['names'][name] = numpy.zeros(y[1] - y[0] + 1, dtype=numpy.int64)
+                    ret['names'][name][row:row + rows] += counts[:, i]
+                continue
+
+            ids = ids.astype(numpy.uint32)
+            if width > 4096:
+                data = numpy.zeros(4096, dtype=numpy.uint16)
+                if 'Data' in section:
+                    data = McChunk.nibbles(section['Data'])
+                ids = ids * 16 + data
+            ids = ids[low * 256:high * 256]
+            ids += numpy.repeat(numpy.arange(rows, dtype=numpy.uint32) * width, 256)
+
+            if width > 4096:
+                keys, count = numpy.unique(ids + numpy.uint32(row * width), return_counts = True)
+                for key, value in zip(keys.tolist(), count.tolist()):
+                    table[key] = table.get(key, 0) + value
+            else:
+                flat = table[row:row + rows].reshape(-1)
+                flat += numpy.bincount(ids, minlength = len(flat))
+        Profile.stop('count', start)
+    # }}}
+
 # }}}
 
 class McRegion: #{{{
 
+    CHUNK_FIELDS = ['region', 'x', 'z', 'index', 'offset', 'sectors', 'length', 'timestamp', 'compression', 'external']
+
     @staticmethod
     def get_coord(coord_string = None, index = -1): # {{{
         if index >= 0:
@@ -236,88 +981,191 @@ class McRegion: #{{{
     # }}}
 
     @staticmethod
-    def decode_nbt(data, compress = None): # {{{
+    def decode_raw(data, compress = None): # {{{
         try:
             if compress == 'zlib':
-                data = zlib.decompress(data)
+                return zlib.decompress(data)
             elif compress == 'gzip':
-                data = gzip.decompress(data)
+                return gzip.decompress(data)
+            elif compress != None or (len(data) > 0 and data[0] == NbtScanner.TAG_COMPOUND):
+                return data
         except Exception as e:
             print(e)
             return None
 
+        for decompress in (zlib.decompress, gzip.decompress):
+            try:
+                return decompress(data)
+            except Exception as e:
+                pass
+        return None
+    # }}}
+
+    @staticmethod
+    def decode_nbt(data, compress = None): # {{{
+        data = McRegion.decode_raw(data, compress)
+        if data == None:
+            return None
+
+        start = Profile.start()
+        tmp_file = io.BytesIO(data)
         try:
-            tmp_file = io.BytesIO(data)
             nbtfile = nbt.NBTFile(buffer=tmp_file)
         except Exception as e:
             nbtfile = None
         finally:
             tmp_file.close()
-
-        if nbtfile == None and compress == None:
-            try:
-                uncompress_data = zlib.decompress(data)
-            except Exception as e:
-                uncompress_data = None
-
-            if uncompress_data == None:
-                try:
-                    uncompress_data = gzip.decompress(data)
-                except Exception as e:
-                    uncompress_data = None
-
-            if uncompress_data == None:
-                return None
-
-            try:
-                tmp_file = io.BytesIO(uncompress_data)
-                nbtfile = nbt.NBTFile(buffer=tmp_file)
-            except Exception as e:
-                nbtfile = None
-            finally:
-                tmp_file.close()
+        Profile.stop('parse', start)
 
         return nbtfile
     # }}}
 
-    def __init__(self, path, isnew = False): #{{{
-        self.path = path
-
-        self.offsets = [[0,0]] * 1024
-        self.times = [0] * 1024
-
+    @staticmethod
+    def get_base(path): # {{{
         filename = os.path.basename(path)
         tmp = filename.split('.');
         if len(tmp) != 4 or tmp[3] != 'mca':
             raise Exception('')
-        self.base = [int(tmp[1]) * 32, int(tmp[2]) * 32]
+        return [int(tmp[1]) * 32, int(tmp[2]) * 32]
+    # }}}
 
-        if not isnew:
-            self.fh = open(self.path, 'rb+')
-            self.load()
-        else:
-            self.fh = open(self.path, 'wb+')
-            self.cur_offset = 2
-            self.fh.truncate(4096 * 2)
+    @staticmethod
+    def parse_header(data): # {{{
+        header = numpy.frombuffer(data, dtype='>u4', count=1024)
+        offsets = numpy.empty((1024, 2), dtype=numpy.int64)
+        offsets[:, 0] = header >> 8
+        offsets[:, 1] = header & 0xFF
+        times = numpy.frombuffer(data, dtype='>i4', count=1024, offset=4096).astype(numpy.int64)
+        return (offsets, times)
+    # }}}
 
+    @staticmethod
+    def read_header(path): # {{{
+        with open(path, 'rb') as f:
+            data = f.read(4096 * 2)
+        if len(data) < 4096 * 2:
+            return (numpy.zeros((1024, 2), dtype=numpy.int64), numpy.zeros(1024, dtype=numpy.int64))
+        return McRegion.parse_header(data)
+    # }}}
+
+    @staticmethod
+    def prune_header(offsets, times, prune): #{{{
+        candidates = offsets[:, 0] != 0
+        if 'before' in prune:
+            candidates &= times < prune['before']
+        return candidates
     #}}}
 
-    def load(self): #{{{
-        offsets_data = self.fh.read(4096)
-        times_data = self.fh.read(4096)
+    @staticmethod
+    def prune_tags(prune): #{{{
+        return 'inhabited' in prune or bool(prune.get('empty'))
+    #}}}
+
+    def get_external(self, index): #{{{
+        coord = McRegion.get_coord(index = index)
+        return os.path.join(os.path.dirname(self.path), 'c.%d.%d.mcc' % (self.base[0] + coord[0], self.base[1] + coord[1]))
+    #}}}
+
+    def __init__(self, path, isnew = False): #{{{
+        self.path = path
+        self.external = set()
+
+        self.offsets = numpy.zeros((1024, 2), dtype=numpy.int64)
+        self.times = numpy.zeros(1024, dtype=numpy.int64)
+        self.mm = None
+        self.view = None
+        self.prefetch = {}
+
+        self.base = McRegion.get_base(path)
+
+        if not isnew:
+            self.fh = open(self.path, 'rb')
+            if os.fstat(self.fh.fileno()).st_size > 0:
+                self.mm = mmap.mmap(self.fh.fileno(), 0, access = mmap.ACCESS_READ)
+                self.view = memoryview(self.mm)
+            self.load()
+        else:
+            self.fh = open(self.path, 'wb+')
+            self.cur_offset = 2
+            self.fh.truncate(4096 * 2)
+
+    #}}}
+
+    def __enter__(self): #{{{
+        return self
+    #}}}
 
+    def __exit__(self, exc_type, exc_value, traceback): #{{{
+        self.close()
+    #}}}
+
+    def close(self): #{{{
+        if self.mm != None:
+            try:
+                self.view.release()
+                self.mm.close()
+            except BufferError as e:
+                pass
+            self.mm = None
+            self.view = None
+        if self.fh != None:
+            self.fh.close()
+            self.fh = None
+    #}}}
+
+    def load(self): #{{{
+        start = Profile.start()
         self.cur_offset = 2
+        if self.mm == None or len(self.mm) < 4096 * 2:
+            return
 
-        for i in range(0, 1024):
-            b1,b2,b3,blen = struct.unpack('4B',offsets_data[i*4:i*4+4])
-            offset = (b1 << 16) | (b2 << 8) | b3
-            time_stamp, = struct.unpack('>i',times_data[i*4:i*4+4])
+        self.offsets[:], self.times[:] = McRegion.parse_header(self.mm)
 
-            if self.cur_offset < offset + blen:
-                self.cur_offset = offset + blen
+        ends = self.offsets[:, 0] + self.offsets[:, 1]
+        self.cur_offset = max(2, int(ends.max()))
+        Profile.stop('load', start)
+        Profile.add('regions_loaded')
+    #}}}
+
+    def chunk_table(self): #{{{
+        indexes = numpy.flatnonzero(self.offsets[:, 0] != 0)
+        pos = self.offsets[indexes, 0] * 4096
+        length = numpy.zeros(len(indexes), dtype=numpy.int64)
+        compress = numpy.zeros(len(indexes), dtype=numpy.int64)
+        if self.mm != None:
+            buf = numpy.frombuffer(self.mm, dtype=numpy.uint8)
+            valid = pos + 5 <= len(buf)
+            head = buf[pos[valid, None] + numpy.arange(5)].astype(numpy.int64)
+            del buf
+            length[valid] = (head[:, 0] << 24) | (head[:, 1] << 16) | (head[:, 2] << 8) | head[:, 3]
+            compress[valid] = head[:, 4]
+        return {
+            'index': indexes,
+            'offset': self.offsets[indexes, 0],
+            'sectors': self.offsets[indexes, 1],
+            'length': length,
+            'timestamp': self.times[indexes],
+            'compression': compress,
+        }
+    #}}}
 
-            self.offsets[i] = [offset, blen]
-            self.times[i] = time_stamp
+    def iter_chunks(self): #{{{
+        table = self.chunk_table()
+        region = os.path.basename(self.path)
+        columns = zip(*[table[i].tolist() for i in ('index', 'offset', 'sectors', 'length', 'timestamp', 'compression')])
+        for index, offset, sectors, data_len, time_stamp, compress_type in columns:
+            yield {
+                'region': region,
+                'x': self.base[0] + index % 32,
+                'z': self.base[1] + index // 32,
+                'index': index,
+                'offset': offset,
+                'sectors': sectors,
+                'length': data_len,
+                'timestamp': time_stamp,
+                'compression': compress_type & 0x7F,
+                'external': compress_type & 0x80 != 0,
+            }
     #}}}
 
     def show_chunks(self, out_file): #{{{
@@ -325,24 +1173,60 @@ class McRegion: #{{{
             if self.offsets[i][0] == 0:
                 continue
             coord = McRegion.get_coord(index = i)
-            local_time = time.localtime(self.times[i])
+            local_time = time.localtime(int(self.times[i]))
             dt = time.strftime('%Y-%m-%d %H:%M:%S',local_time)
 
             print('%4d (%2d,%2d) => %s' % (i, coord[0], coord[1], dt), file=out_file)
         return
     #}}}
 
+    def reserve(self, blocks): #{{{
+        size = (self.cur_offset + blocks) * 4096
+        try:
+            os.posix_fallocate(self.fh.fileno(), 0, size)
+        except (AttributeError, OSError) as e:
+            self.fh.truncate(size)
+    #}}}
+
+    def add_external(self, chunk, index): #{{{
+        path = self.get_external(index)
+        start = Profile.start()
+        size = -1
+        if chunk.is_external():
+            if chunk.external != None:
+                McWorld.copy_file(chunk.external_path, path)
+                size = len(chunk.external)
+        else:
+            with open(path, 'wb') as f:
+                f.write(chunk.data[1:])
+            size = len(chunk.data) - 1
+        Profile.stop('write', start)
+        if size >= 0:
+            Profile.add('bytes_written', size)
+            self.external.add(os.path.basename(path))
+        return bytes([chunk.data[0] | 0x80])
+    #}}}
+
     def add_chunk(self, chunk): #{{{
         index, blocks, time_stamp = chunk.get_info()
+        data = chunk.data
+        if chunk.is_external() or blocks > 255:
+            data = self.add_external(chunk, index)
+            blocks = 1
 
         self.offsets[index] = (self.cur_offset, blocks)
         self.times[index] = time_stamp
 
-        self.fh.seek(self.cur_offset * 4096, 0)
-        self.fh.write(chunk.pack_data())
+        start = Profile.start()
+        if self.fh.tell() != self.cur_offset * 4096:
+            self.fh.seek(self.cur_offset * 4096, 0)
+        self.fh.write(struct.pack('>i', len(data)))
+        self.fh.write(data)
+        self.fh.write(bytes(blocks * 4096 - len(data) - 4))
+        Profile.stop('write', start)
+        Profile.add('bytes_written', blocks * 4096)
 
         self.cur_offset += blocks
-        self.fh.truncate(self.cur_offset * 4096)
     #}}}
 
     def get_chunk(self, index = -1, coord = None): #{{{
@@ -351,82 +1235,693 @@ class McRegion: #{{{
                 return None
             index = McRegion.get_index(coord)
 
+        if index in self.prefetch:
+            return self.prefetch.pop(index)
+
         if self.offsets[index][0] == 0:
             return None
 
         chunk = McChunk()
-        chunk.set_info(coord = coord, index = index, time_stamp = self.times[index])
+        chunk.set_info(coord = coord, index = index, time_stamp = int(self.times[index]))
         chunk.set_file(self.path)
 
-        self.fh.seek(self.offsets[index][0] * 4096)
-        info = self.fh.read(4)
-        data_len, = struct.unpack('>i',info)
-        zip_data = self.fh.read(data_len)
-
-        chunk.set_data(zip_data)
+        start = Profile.start()
+        pos = int(self.offsets[index][0]) * 4096
+        if self.view == None or pos + 4 > len(self.view):
+            chunk.set_data(b'')
+            return chunk
+        data_len, = struct.unpack_from('>i', self.view, pos)
+        chunk.set_data(self.view[pos + 4:pos + 4 + max(data_len, 0)])
+        if chunk.is_external():
+            chunk.set_external(self.get_external(index))
+            self.external.add(os.path.basename(chunk.external_path))
+        Profile.stop('read', start)
+        Profile.add('bytes_read', data_len + 4)
         return chunk
     #}}}
 
     def write(self): #{{{
-        of_f = io.BytesIO()
-        ti_f = io.BytesIO()
-
-        for i in range(0, 1024):
-            of_f.write(struct.pack('4B', self.offsets[i][0] >> 16, (self.offsets[i][0] >> 8) & 0xFF, self.offsets[i][0] & 0xFF, self.offsets[i][1]))
-            ti_f.write(struct.pack('>i', self.times[i]))
+        header = (self.offsets[:, 0] << 8) | self.offsets[:, 1]
 
         self.fh.seek(0,0)
-        self.fh.write(of_f.getvalue())
-        self.fh.write(ti_f.getvalue())
+        self.fh.write(header.astype('>u4').tobytes())
+        self.fh.write(self.times.astype('>i4').tobytes())
+        self.fh.truncate(self.cur_offset * 4096)
 
     #}}}
 
     def move_file(self, index, args, ret): #{{{
         new_file = args['dst_file']
         chunk = self.get_chunk(index = index)
+        if 'prune' in args and args['prune'][0][index] and chunk.can_prune(args['prune'][1]):
+            return McWorld.merge_count(ret, {'pruned': 1})
+        count = {'chunks': 1}
+        if 'compress' in args:
+            count['before'] = chunk.get_size()
+            try:
+                raw = chunk.decompress()
+            except Exception as e:
+                raw = None
+                Profile.add('chunks_corrupt')
+                count = McWorld.merge_count(count, self.corrupt(index))
+            if raw != None:
+                chunk.recompress(*args['compress'], raw = raw)
+            count['after'] = chunk.get_size()
         new_file.add_chunk(chunk)
+        return McWorld.merge_count(ret, count)
+    #}}}
+
+    def get_cached(self, index, args): #{{{
+        if not 'cached' in args:
+            return None
+        key = (int(self.times[index]), int(self.offsets[index][0]))
+        cached = args['cached'].get(index)
+        if cached != None and cached[0] == key:
+            return cached[1]
+        return None
     #}}}
 
     def calc_block(self, index, args, ret): #{{{
-        chunk = self.get_chunk(index = index)
-        count = chunk.calc_block(args)
-        if ret == None:
-            return count
-        for item in ret:
-            if item in count:
-                count[item] += ret[item]
+        if not 'cached' in args:
+            chunk = self.get_chunk(index = index)
+            count = chunk.calc_block(args)
+        else:
+            key = (int(self.times[index]), int(self.offsets[index][0]))
+            cached = self.get_cached(index, args)
+            if cached != None:
+                Profile.add('chunks_cached')
+                count = json.loads(cached)
             else:
-                count[item] = ret[item]
-        return count
+                chunk = self.get_chunk(index = index)
+                count = chunk.calc_block(args)
+                cached = json.dumps(count)
+            if count != None:
+                args['rows'].append((index, key[0], key[1], cached))
+
+        if count == None:
+            return McWorld.merge_count(ret, self.corrupt(index))
+        if 'grid' in args:
+            args['grid'].append((index, [count.get(name, 0) for name in args['rules'][0]]))
+        return McWorld.merge_count(ret, count)
     #}}}
 
-    def walk(self, region_list, call, args): #{{{
-        ret = None
+    def corrupt(self, index): #{{{
+        coord = [self.base[0] + index % 32, self.base[1] + index // 32]
+        print('区块数据错误: %s (%d,%d)' % (os.path.basename(self.path), coord[0], coord[1]), file=sys.stderr)
+        return {'__corrupt__': [[os.path.basename(self.path)] + coord]}
+    #}}}
 
-        chunks = [0] * 1024
-        region_list.apply(self.base, chunks)
+    def calc_hist(self, index, args, ret): #{{{
+        if ret is None:
+            ret = {'ids': McChunk.hist_table(args), 'names': {}}
+        chunk = self.get_chunk(index = index)
+        if chunk.calc_hist(args, ret) == False:
+            self.corrupt(index)
+        return ret
+    #}}}
 
-        for i in range(0, 1024):
-            if self.offsets[i][0] == 0 and self.times[i] == 0:
-                continue
-            if chunks[i] == 0:
-                continue
-            ret = call(i, args, ret)
+    def walk(self, region_list, call, args, mask = None): #{{{
+        ret = None
+
+        present = self.offsets[:, 0] != 0
+        chunks = mask.copy() if mask is not None else region_list.mask(self.base)
+        Profile.add('chunks_skipped', int(numpy.count_nonzero(present & ~chunks)))
+        chunks &= present
+        Profile.add('chunks_visited', int(numpy.count_nonzero(chunks)))
+        indexes = numpy.flatnonzero(chunks).tolist()
+
+        threads = 0
+        if 'threads' in args:
+            threads = args['threads']
+        if threads <= 0:
+            for i in indexes:
+                ret = call(i, args, ret)
+            return ret
+
+        depth = threads * 4
+        if 'depth' in args:
+            depth = max(1, args['depth'])
+        decoded = self.decode_chunks([i for i in indexes if self.get_cached(i, args) == None], threads, depth)
+        try:
+            for i in indexes:
+                if self.get_cached(i, args) == None:
+                    chunk = next(decoded)
+                    self.prefetch[chunk.index] = chunk
+                ret = call(i, args, ret)
+        finally:
+            decoded.close()
+            self.prefetch.clear()
         return ret
     #}}}
 
-    def compare(self, right):#{{{
-        for i in range(0, 1024):
-            ldata = self.get_trunk(i)
-            rdata = right.get_trunk(i)
-            if ldata[0] != rdata[0] or ldata[1] != rdata[1]:
-                print('chunk: %d [%d %d]' % (i, ldata[0],rdata[0]))
-                return False
-        return True
+    @staticmethod
+    def decoded(chunk, future): #{{{
+        try:
+            chunk.set_raw(future.result())
+        except Exception as e:
+            pass
+        return chunk
+    #}}}
+
+    def decode_chunks(self, indexes, threads, depth): #{{{
+        with concurrent.futures.ThreadPoolExecutor(max_workers = threads) as pool:
+            queue = collections.deque()
+            for index in indexes:
+                chunk = self.get_chunk(index = index)
+                queue.append((chunk, pool.submit(chunk.decompress)))
+                while len(queue) >= depth:
+                    yield McRegion.decoded(*queue.popleft())
+            while len(queue) > 0:
+                yield McRegion.decoded(*queue.popleft())
+    #}}}
+
+    def get_hash(self, index, args): #{{{
+        cached = self.get_cached(index, args)
+        if cached != None:
+            Profile.add('hashes_cached')
+            return cached
+
+        start = Profile.start()
+        pos = int(self.offsets[index][0]) * 4096
+        data_len = 0
+        if self.view != None and pos + 4 <= len(self.view):
+            data_len, = struct.unpack_from('>i', self.view, pos)
+        if data_len <= 0 or pos + 4 + data_len > len(self.view):
+            Profile.add('chunks_corrupt')
+            self.corrupt(index)
+            data_len = 0 if self.view == None else max(0, min(data_len, len(self.view) - pos - 4))
+        digest = hashlib.blake2b(self.view[pos + 4:pos + 4 + data_len], digest_size = 16)
+        if data_len > 0 and self.view[pos + 4] & 0x80:
+            chunk = McChunk()
+            chunk.set_data(self.view[pos + 4:pos + 4 + data_len])
+            chunk.set_external(self.get_external(index))
+            if chunk.external != None:
+                digest.update(chunk.external)
+                data_len += len(chunk.external)
+        digest = digest.hexdigest()
+        Profile.stop('hash', start)
+        Profile.add('bytes_hashed', data_len)
+
+        if 'rows' in args:
+            args['rows'].append((index, int(self.times[index]), int(self.offsets[index][0]), digest))
+        return digest
+    #}}}
+
+    @staticmethod
+    def diff_header(left, right): #{{{
+        lpresent = left[0][:, 0] != 0
+        rpresent = right[0][:, 0] != 0
+        both = lpresent & rpresent
+        same = both & (left[1] == right[1]) & (left[0][:, 1] == right[0][:, 1])
+        return (rpresent & ~lpresent, lpresent & ~rpresent, both & ~same, same)
+    #}}}
+
+    def compare(self, right, args = None, right_args = None): #{{{
+        if args == None:
+            args = {}
+        if right_args == None:
+            right_args = {}
+        added, removed, check, same = McRegion.diff_header((self.offsets, self.times), (right.offsets, right.times))
+        changed = numpy.zeros(1024, dtype=bool)
+        for i in numpy.flatnonzero(check).tolist():
+            if self.get_hash(i, args) != right.get_hash(i, right_args):
+                changed[i] = True
+            else:
+                same[i] = True
+        return (added, removed, changed, same)
     #}}}
 
 #}}}
 
+class SqliteCache: # {{{
+
+    TABLE = None
+    SCHEMA = None
+
+    def __init__(self, path, max_size = 1000000): # {{{
+        self.path = path
+        self.max_size = max_size
+        self.used = int(time.time())
+        self.db = None
+    # }}}
+
+    def __getstate__(self): # {{{
+        state = self.__dict__.copy()
+        state['db'] = None
+        return state
+    # }}}
+
+    def connect(self): # {{{
+        if self.db == None:
+            self.db = sqlite3.connect(self.path, timeout = 60)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (self.TABLE, self.SCHEMA))
+        return self.db
+    # }}}
+
+    def close(self): # {{{
+        if self.db != None:
+            self.db.close()
+            self.db = None
+    # }}}
+
+    def evict(self): # {{{
+        db = self.connect()
+        size, = db.execute('SELECT COUNT(*) FROM %s' % self.TABLE).fetchone()
+        if size <= self.max_size:
+            return
+        with db:
+            db.execute('DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY used LIMIT ?)' % (self.TABLE, self.TABLE), (size - self.max_size,))
+    # }}}
+
+# }}}
+
+class CalcCache(SqliteCache): # {{{
+
+    TABLE = 'chunks'
+    SCHEMA = 'file TEXT, idx INTEGER, stamp INTEGER, offset INTEGER, rules TEXT, count TEXT, used INTEGER, PRIMARY KEY (file, idx, rules)'
+
+    @staticmethod
+    def get_key(args): # {{{
+        calc = {}
+        for name in args['calc']:
+            calc[name] = {}
+            for rtype in args['calc'][name]:
+                calc[name][rtype] = sorted(args['calc'][name][rtype], key = lambda bid: (isinstance(bid, str), bid))
+        y = None
+        if 'y' in args:
+            y = args['y']
+        data = json.dumps({'calc': calc, 'y': y}, sort_keys = True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+    # }}}
+
+    def __init__(self, path, key, max_size = 1000000): # {{{
+        SqliteCache.__init__(self, path, max_size)
+        self.key = key
+    # }}}
+
+    def load(self, file_path): # {{{
+        ret = {}
+        cursor = self.connect().execute('SELECT idx, stamp, offset, count FROM chunks WHERE file = ? AND rules = ?', (file_path, self.key))
+        for index, stamp, offset, count in cursor:
+            ret[index] = ((stamp, offset), count)
+        return ret
+    # }}}
+
+    def store(self, file_path, rows): # {{{
+        db = self.connect()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(file_path, index, stamp, offset, self.key, count, self.used) for index, stamp, offset, count in rows])
+    # }}}
+
+    def rebuild(self): # {{{
+        db = self.connect()
+        with db:
+            db.execute('DELETE FROM chunks WHERE rules = ?', (self.key,))
+    # }}}
+
+# }}}
+
+class HashCache(SqliteCache): # {{{
+
+    TABLE = 'hashes'
+    SCHEMA = 'file TEXT, idx INTEGER, stamp INTEGER, offset INTEGER, digest TEXT, used INTEGER, PRIMARY KEY (file, idx)'
+
+    def load(self, file_path): # {{{
+        ret = {}
+        cursor = self.connect().execute('SELECT idx, stamp, offset, digest FROM hashes WHERE file = ?', (file_path,))
+        for index, stamp, offset, digest in cursor:
+            ret[index] = ((stamp, offset), digest)
+        return ret
+    # }}}
+
+    def store(self, file_path, rows): # {{{
+        db = self.connect()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                [(file_path, index, stamp, offset, digest, self.used) for index, stamp, offset, digest in rows])
+    # }}}
+
+# }}}
+
+class Journal: # {{{
+
+    @staticmethod
+    def get_key(cmd, config, args): # {{{
+        job = {'cmd': cmd, 'args': args}
+        job['config'] = dict((k, v) for k, v in config.items() if not k in ('workers', 'threads', 'depth', 'cache', 'cache_size'))
+        data = json.dumps(job, sort_keys = True, default = list)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+    # }}}
+
+    def __init__(self, path, key): # {{{
+        self.path = path
+        self.key = key
+        self.done = {}
+        self.fh = None
+    # }}}
+
+    def load(self): # {{{
+        if not os.path.exists(self.path):
+            return True
+        with open(self.path, 'r', encoding = 'utf-8') as f:
+            for i, line in enumerate(f):
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    continue
+                if i == 0:
+                    if row.get('key') != self.key:
+                        return False
+                elif 'file' in row:
+                    self.done[row['file']] = row['count']
+        return True
+    # }}}
+
+    def open(self, resume = False): # {{{
+        if resume and os.path.exists(self.path):
+            self.fh = open(self.path, 'a', encoding = 'utf-8')
+            return
+        self.done = {}
+        self.fh = open(self.path, 'w', encoding = 'utf-8')
+        self.fh.write(json.dumps({'key': self.key}) + '\n')
+        self.fh.flush()
+    # }}}
+
+    def write(self, file_name, count): # {{{
+        self.fh.write(json.dumps({'file': file_name, 'count': count}, ensure_ascii = False, default = lambda value: value.tolist()) + '\n')
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+    # }}}
+
+    def close(self): # {{{
+        if self.fh != None:
+            self.fh.close()
+            self.fh = None
+    # }}}
+
+# }}}
+
+class CalcPartial: # {{{
+
+    VERSION = 1
+
+    def __init__(self, path): # {{{
+        self.path = path
+        self.meta = None
+        self.count = None
+    # }}}
+
+    def load(self): # {{{
+        try:
+            with open(self.path, 'r', encoding = 'utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            return False
+        if not isinstance(data, dict) or data.get('version') != CalcPartial.VERSION:
+            return False
+        if not 'meta' in data or not 'count' in data:
+            return False
+        self.meta = data['meta']
+        self.count = data['count']
+        return True
+    # }}}
+
+    def save(self, meta, count): # {{{
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump({'version': CalcPartial.VERSION, 'meta': meta, 'count': count}, f, ensure_ascii = False, default = lambda value: value.tolist())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.meta = meta
+        self.count = count
+    # }}}
+
+    def check(self, other): # {{{
+        if self.meta['y'] != other.meta['y']:
+            return '高度范围不一致'
+        if self.meta['key'] != other.meta['key'] or self.meta['names'] != other.meta['names']:
+            return '统计规则不一致'
+        if (self.meta['sample'] == None) != (other.meta['sample'] == None):
+            return '抽样设置不一致'
+        return None
+    # }}}
+
+# }}}
+
+class ChunkGrid: # {{{
+
+    PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+    DENSE_CELLS = 1 << 20
+    DENSE_RATIO = 16
+
+    @staticmethod
+    def pack(base, rows, size): # {{{
+        indexes = numpy.array([i[0] for i in rows], dtype=numpy.int16)
+        values = numpy.array([i[1] for i in rows], dtype=numpy.int64).reshape(len(rows), size)
+        return (base, indexes, values)
+    # }}}
+
+    def __init__(self, names, regions): # {{{
+        self.names = list(names)
+        self.x0 = 0
+        self.z0 = 0
+        self.width = 0
+        self.height = 0
+        self.x = numpy.zeros(0, dtype=numpy.int64)
+        self.z = numpy.zeros(0, dtype=numpy.int64)
+        self.values = numpy.zeros((0, len(self.names)), dtype=numpy.int64)
+
+        regions = [(base, numpy.asarray(indexes, dtype=numpy.int16), numpy.asarray(values, dtype=numpy.int64).reshape(len(indexes), len(self.names))) for base, indexes, values in regions.values() if len(indexes) > 0]
+        if len(regions) <= 0:
+            return
+        x = numpy.concatenate([numpy.int64(base[0]) + indexes % 32 for base, indexes, values in regions])
+        z = numpy.concatenate([numpy.int64(base[1]) + indexes // 32 for base, indexes, values in regions])
+        order = numpy.lexsort((x, z))
+        self.x = x[order]
+        self.z = z[order]
+        self.values = numpy.concatenate([values for base, indexes, values in regions])[order]
+        self.x0 = int(self.x.min())
+        self.z0 = int(self.z.min())
+        self.width = int(self.x.max()) - self.x0 + 1
+        self.height = int(self.z.max()) - self.z0 + 1
+    # }}}
+
+    def get_rule(self, name): # {{{
+        if name == None:
+            return 0
+        if not name in self.names:
+            return -1
+        return self.names.index(name)
+    # }}}
+
+    def can_dense(self): # {{{
+        return self.width * self.height <= max(ChunkGrid.DENSE_CELLS, ChunkGrid.DENSE_RATIO * len(self.x))
+    # }}}
+
+    def dense(self, rule = None): # {{{
+        if not self.can_dense():
+            return None
+        present = numpy.zeros((self.height, self.width), dtype=bool)
+        present[self.z - self.z0, self.x - self.x0] = True
+        if rule != None:
+            data = numpy.zeros((self.height, self.width), dtype=numpy.int64)
+            data[self.z - self.z0, self.x - self.x0] = self.values[:, rule]
+        else:
+            data = numpy.zeros((len(self.names), self.height, self.width), dtype=numpy.int64)
+            data[:, self.z - self.z0, self.x - self.x0] = self.values.T
+        return (data, present)
+    # }}}
+
+    def top(self, rule, limit): # {{{
+        values = self.values[:, rule]
+        limit = min(limit, len(values))
+        if limit <= 0:
+            return []
+        found = numpy.argpartition(-values, limit - 1)[:limit]
+        found = found[numpy.argsort(-values[found], kind = 'stable')]
+        return [(int(self.x[i]), int(self.z[i]), self.values[i].tolist()) for i in found.tolist()]
+    # }}}
+
+    def save_npz(self, out_file): # {{{
+        numpy.savez_compressed(out_file, x = self.x, z = self.z, values = self.values, names = numpy.array(self.names, dtype=str))
+    # }}}
+
+    def save_csv(self, out_file): # {{{
+        writer = csv.writer(out_file)
+        writer.writerow(['x', 'z'] + self.names)
+        for x, z, values in zip(self.x.tolist(), self.z.tolist(), self.values.tolist()):
+            writer.writerow([x, z] + values)
+    # }}}
+
+    @staticmethod
+    def png_chunk(tag, data): # {{{
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+    # }}}
+
+    def save_png(self, out_file, rule, scale = None): # {{{
+        data, present = self.dense(rule)
+        height, width = present.shape
+        if scale == None:
+            scale = max(1, min(8, 1024 // max(width, height, 1)))
+
+        values = data.astype(numpy.float64)
+        pixels = numpy.zeros((height, width), dtype=numpy.uint8)
+        if present.any():
+            low = values[present].min()
+            high = values[present].max()
+            pixels[:] = 1 + numpy.round((values - low) / max(high - low, 1) * 254).clip(0, 254).astype(numpy.uint8)
+        pixels[~present] = 0
+        pixels = pixels.repeat(scale, axis = 0).repeat(scale, axis = 1)
+
+        level = numpy.arange(256, dtype=numpy.float64) / 255
+        palette = numpy.zeros((256, 3), dtype=numpy.uint8)
+        palette[:, 0] = numpy.clip(level * 3, 0, 1) * 255
+        palette[:, 1] = numpy.clip(level * 3 - 1, 0, 1) * 255
+        palette[:, 2] = numpy.clip(level * 3 - 2, 0, 1) * 255
+        palette[0] = (32, 32, 32)
+
+        rows = numpy.zeros((pixels.shape[0], pixels.shape[1] + 1), dtype=numpy.uint8)
+        rows[:, 1:] = pixels
+        out_file.write(ChunkGrid.PNG_MAGIC)
+        out_file.write(ChunkGrid.png_chunk(b'IHDR', struct.pack('>IIBBBBB', pixels.shape[1], pixels.shape[0], 8, 3, 0, 0, 0)))
+        out_file.write(ChunkGrid.png_chunk(b'PLTE', palette.tobytes()))
+        out_file.write(ChunkGrid.png_chunk(b'IDAT', zlib.compress(rows.tobytes(), 9)))
+        out_file.write(ChunkGrid.png_chunk(b'IEND', b''))
+    # }}}
+
+    def save(self, path, rule = 0): # {{{
+        ext = os.path.splitext(path)[1].lower()
+        if ext in ('.png', '.npy') and not self.can_dense():
+            return False
+        if ext == '.csv':
+            with open(path, 'w', newline = '', encoding = 'utf-8') as out_file:
+                self.save_csv(out_file)
+        elif ext == '.png':
+            with open(path, 'wb') as out_file:
+                self.save_png(out_file, rule)
+        elif ext == '.npy':
+            numpy.save(path, self.dense()[0])
+        else:
+            with open(path, 'wb') as out_file:
+                self.save_npz(out_file)
+        return True
+    # }}}
+
+# }}}
+
+class WorldIndex: # {{{
+
+    VERSION = 1
+    REGION_DTYPE = numpy.dtype([('x', '<i4'), ('z', '<i4'), ('mtime', '<i8'), ('size', '<i8'), ('start', '<i8'), ('count', '<i4')])
+    CHUNK_DTYPE = numpy.dtype([('x', '<i4'), ('z', '<i4'), ('offset', '<u4'), ('length', '<u4'), ('timestamp', '<i8'),
+        ('index', '<u2'), ('sectors', 'u1'), ('compression', 'u1'), ('sections', '<i2'), ('hash', 'V16')])
+
+    def __init__(self, path): # {{{
+        self.path = path
+        self.meta = None
+        self.regions = numpy.zeros(0, dtype=WorldIndex.REGION_DTYPE)
+        self.chunks = numpy.zeros(0, dtype=WorldIndex.CHUNK_DTYPE)
+    # }}}
+
+    def load(self): # {{{
+        try:
+            with open(os.path.join(self.path, 'index.json'), 'r', encoding = 'utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != WorldIndex.VERSION:
+                return False
+            regions = numpy.load(os.path.join(self.path, 'regions.npy'), mmap_mode = 'r')
+            chunks = numpy.load(os.path.join(self.path, 'chunks.npy'), mmap_mode = 'r')
+        except (OSError, ValueError) as e:
+            return False
+        if regions.dtype != WorldIndex.REGION_DTYPE or chunks.dtype != WorldIndex.CHUNK_DTYPE:
+            return False
+        self.meta = meta
+        self.regions = regions
+        self.chunks = chunks
+        return True
+    # }}}
+
+    def get_region(self, coord): # {{{
+        found = numpy.flatnonzero((self.regions['x'] == coord[0]) & (self.regions['z'] == coord[1]))
+        if len(found) <= 0:
+            return None
+        return self.regions[found[0]]
+    # }}}
+
+    def save(self, meta, regions, chunks): # {{{
+        os.makedirs(self.path, exist_ok = True)
+        files = []
+        for name, data in (('chunks.npy', chunks), ('regions.npy', regions)):
+            tmp_path = os.path.join(self.path, name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                numpy.save(f, data)
+                f.flush()
+                os.fsync(f.fileno())
+            files.append((tmp_path, os.path.join(self.path, name)))
+        tmp_path = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump(meta, f)
+        files.append((tmp_path, os.path.join(self.path, 'index.json')))
+        for tmp_path, path in files:
+            os.replace(tmp_path, path)
+    # }}}
+
+    def select(self, region_list = None): # {{{
+        if region_list == None:
+            return self.chunks
+        return self.chunks[region_list.contains(self.chunks['x'], self.chunks['z'])]
+    # }}}
+
+    @staticmethod
+    def region_keys(rx, rz): # {{{
+        return numpy.asarray(rx).astype(numpy.int64) << 32 | (numpy.asarray(rz).astype(numpy.int64) & 0xFFFFFFFF)
+    # }}}
+
+    def coverage(self, region_list = None): # {{{
+        chunks = self.select(region_list)
+        ret = {'regions': len(self.regions), 'chunks': len(chunks), 'full_regions': int(numpy.count_nonzero(self.regions['count'] == 1024))}
+        if len(chunks) > 0:
+            ret['x'] = [int(chunks['x'].min()), int(chunks['x'].max())]
+            ret['z'] = [int(chunks['z'].min()), int(chunks['z'].max())]
+            ret['touched_regions'] = len(numpy.unique(WorldIndex.region_keys(chunks['x'] >> 5, chunks['z'] >> 5)))
+        return ret
+    # }}}
+
+    def age(self, region_list = None): # {{{
+        chunks = self.select(region_list)
+        ret = {'chunks': len(chunks), 'months': {}}
+        if len(chunks) <= 0:
+            return ret
+        times = numpy.asarray(chunks['timestamp'])
+        ret['oldest'] = int(times.min())
+        ret['newest'] = int(times.max())
+        months, count = numpy.unique(times.astype('datetime64[s]').astype('datetime64[M]'), return_counts = True)
+        ret['months'] = dict(zip([str(i) for i in months], count.tolist()))
+        return ret
+    # }}}
+
+    def size(self, region_list = None, limit = 10): # {{{
+        chunks = self.select(region_list)
+        regions = self.regions
+        if region_list != None:
+            regions = regions[numpy.isin(WorldIndex.region_keys(regions['x'], regions['z']), WorldIndex.region_keys(chunks['x'] >> 5, chunks['z'] >> 5))]
+        ret = {'chunks': len(chunks), 'bytes': int(chunks['length'].sum(dtype=numpy.int64)), 'sectors': int(chunks['sectors'].sum(dtype=numpy.int64)),
+            'regions': len(regions), 'files': int(regions['size'].sum(dtype=numpy.int64)), 'external': int(numpy.count_nonzero(chunks['compression'] & 0x80)), 'compression': {}, 'largest': []}
+        compress, count = numpy.unique(chunks['compression'] & 0x7F, return_counts = True)
+        for value, number in zip(compress.tolist(), count.tolist()):
+            ret['compression'][str(value)] = number
+        if len(chunks) > 0:
+            order = numpy.argsort(-chunks['length'].astype(numpy.int64), kind = 'stable')[:limit]
+            for i in order.tolist():
+                ret['largest'].append({'x': int(chunks['x'][i]), 'z': int(chunks['z'][i]), 'length': int(chunks['length'][i]), 'sectors': int(chunks['sectors'][i])})
+        return ret
+    # }}}
+
+# }}}
+
 class McWorld: #{{{
 
     @staticmethod
@@ -459,80 +1954,595 @@ class McWorld: #{{{
         return file_region
     # }}}
 
-    def __init__(self, path): #{{{
+    def __init__(self, path, max_open = 16): #{{{
         path = os.path.abspath(path)
         self.path = path
+        self.max_open = max_open
+        self.regions = collections.OrderedDict()
     #}}}
 
-    def get_chunk(self, coord): #{{{
-        file_name = 'r.%d.%d.mca' % (coord[0] // 16, coord[1] // 16)
+    def __getstate__(self): #{{{
+        state = self.__dict__.copy()
+        state['regions'] = collections.OrderedDict()
+        return state
+    #}}}
+
+    def __enter__(self): #{{{
+        return self
+    #}}}
+
+    def __exit__(self, exc_type, exc_value, traceback): #{{{
+        self.close()
+    #}}}
+
+    def close(self): #{{{
+        for region in self.regions.values():
+            region.close()
+        self.regions.clear()
+    #}}}
+
+    def get_region(self, coord): #{{{
+        file_name = 'r.%d.%d.mca' % (coord[0], coord[1])
+        if file_name in self.regions:
+            self.regions.move_to_end(file_name)
+            return self.regions[file_name]
+
         file_path = os.path.join(self.path, file_name)
         if not os.path.exists(file_path):
             return None
-        x = McRegion(file_path)
-        return x.get_chunk(coord = coord)
+        region = McRegion(file_path)
+        self.regions[file_name] = region
+        while len(self.regions) > self.max_open:
+            file_name, old = self.regions.popitem(last = False)
+            old.close()
+        return region
     #}}}
 
+    def get_chunk(self, coord): #{{{
+        region = self.get_region([coord[0] // 32, coord[1] // 32])
+        if region == None:
+            return None
+        return region.get_chunk(coord = coord)
+    #}}}
+
+    @staticmethod
+    def merge_count(ret, count): # {{{
+        if count is None:
+            return ret
+        if ret is None:
+            return count
+        if isinstance(count, numpy.ndarray):
+            count += ret
+            return count
+        for item in ret:
+            if not item in count:
+                count[item] = ret[item]
+            elif isinstance(count[item], dict):
+                count[item] = McWorld.merge_count(ret[item], count[item])
+            else:
+                count[item] += ret[item]
+        return count
+    # }}}
+
+    @staticmethod
+    def copy_file(src_path, dst_path): # {{{
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            for name in ('copy_file_range', 'sendfile'):
+                func = getattr(os, name, None)
+                if func == None:
+                    continue
+                try:
+                    copied = 0
+                    while copied < size:
+                        if name == 'sendfile':
+                            n = func(dst.fileno(), src.fileno(), copied, size - copied)
+                        else:
+                            n = func(src.fileno(), dst.fileno(), size - copied, copied, copied)
+                        if n == 0:
+                            break
+                        copied += n
+                    if copied == size:
+                        return
+                except (AttributeError, OSError) as e:
+                    pass
+        shutil.copyfile(src_path, dst_path)
+    # }}}
+
     def move_data(self, region_list, file_name, args, ret): #{{{
-        print(file_name)
         src_path = os.path.join(self.path, file_name)
         dst = args['dst']
         dst_path = os.path.join(dst, file_name)
 
-        x = McRegion(src_path)
-        new_file = McRegion(dst_path, True)
+        chunks = region_list.mask(McRegion.get_base(src_path))
+        if not chunks.any():
+            return ret
+
+        pruned = 0
+        candidates = numpy.zeros(1024, dtype=bool)
+        if 'prune' in args:
+            offsets, times = McRegion.read_header(src_path)
+            candidates = McRegion.prune_header(offsets, times, args['prune']) & chunks
+            if not McRegion.prune_tags(args['prune']):
+                pruned = int(numpy.count_nonzero(candidates))
+                chunks &= ~candidates
+                candidates[:] = False
+                if not (chunks & (offsets[:, 0] != 0)).any():
+                    return McWorld.merge_count(ret, {'files': 0, 'chunks': 0, 'pruned': pruned})
+
+        print(file_name)
+        if chunks.all() and not 'compress' in args and not candidates.any():
+            header = numpy.fromfile(src_path, dtype='>u4', count=1024)
+            McWorld.copy_file(src_path, dst_path)
+            base = McRegion.get_base(src_path)
+            for index in numpy.flatnonzero((header & 0xFF) == 1).tolist():
+                mcc_name = 'c.%d.%d.mcc' % (base[0] + index % 32, base[1] + index // 32)
+                if os.path.exists(os.path.join(self.path, mcc_name)):
+                    McWorld.copy_file(os.path.join(self.path, mcc_name), os.path.join(dst, mcc_name))
+            return McWorld.merge_count(ret, {'files': 1, 'chunks': int(numpy.count_nonzero(header >> 8))})
+
+        x = McRegion(src_path)
+        new_file = McRegion(dst_path, True)
+
+        keep = chunks & (x.offsets[:, 0] != 0)
+        new_file.reserve(int(x.offsets[keep, 1].sum()))
+        region_args = {'dst_file': new_file}
+        if 'compress' in args:
+            region_args['compress'] = args['compress']
+        if candidates.any():
+            region_args['prune'] = (candidates, args['prune'])
+        count = x.walk(region_list, x.move_file, region_args, chunks)
+        new_file.write()
+        new_file.close()
+        x.close()
+        count = McWorld.merge_count({'files': 1, 'chunks': 0, 'pruned': pruned}, count)
+        return McWorld.merge_count(ret, count)
+    #}}}
+
+    def calc_block(self, region_list, file_name, args, ret): #{{{
+        src_path = os.path.join(self.path, file_name)
+
+        region_args = args
+        if 'cache' in args or 'grid' in args or 'sample' in args:
+            region_args = dict(args)
+        if 'cache' in args:
+            region_args['cached'] = args['cache'].load(src_path)
+            region_args['rows'] = []
+        if 'grid' in args or 'sample' in args:
+            region_args['grid'] = []
+
+        with McRegion(src_path) as x:
+            mask = None
+            if 'sample' in args:
+                mask, total = McWorld.sample_mask(x, region_list, args)
+            count = x.walk(region_list, x.calc_block, region_args, mask)
+            if 'stats' in args:
+                chunks = (mask if mask is not None else region_list.mask(x.base)) & (x.offsets[:, 0] != 0)
+                stats = {'files': 1, 'chunks': int(numpy.count_nonzero(chunks)), 'bytes': int(x.offsets[chunks, 1].sum()) * 4096}
+
+        if 'cache' in args:
+            args['cache'].store(src_path, region_args['rows'])
+        if count == None:
+            if not 'stats' in args:
+                return ret
+            count = {}
+        if 'stats' in args:
+            count['__stats__'] = stats
+        if 'grid' in args:
+            count['__grid__'] = {file_name: ChunkGrid.pack(McRegion.get_base(src_path), region_args['grid'], len(args['rules'][0]))}
+        if 'sample' in args:
+            count['__sample__'] = McWorld.sample_count(args['rules'][0], region_args['grid'], total)
+        return McWorld.merge_count(ret, count)
+    #}}}
+
+    @staticmethod
+    def sample_mask(region, region_list, args): #{{{
+        candidates = numpy.flatnonzero(region_list.mask(region.base) & (region.offsets[:, 0] != 0))
+        total = len(candidates)
+        size = min(total, max(2, int(numpy.ceil(args['sample'] * total))))
+        rng = numpy.random.default_rng([args.get('seed', 0), region.base[0] & 0xFFFFFFFF, region.base[1] & 0xFFFFFFFF])
+        mask = numpy.zeros(1024, dtype=bool)
+        mask[rng.choice(candidates, size, replace = False)] = True
+        Profile.add('chunks_sampled', size)
+        return (mask, total)
+    #}}}
+
+    @staticmethod
+    def sample_count(names, rows, total): #{{{
+        values = ChunkGrid.pack([0, 0], rows, len(names))[2].astype(numpy.float64)
+        size = len(values)
+        est = numpy.zeros(len(names))
+        var = numpy.zeros(len(names))
+        if size > 0:
+            est = values.mean(axis = 0) * total
+        if size > 1:
+            var = total * total * (1 - size / total) * values.var(axis = 0, ddof = 1) / size
+        return {'n': size, 'N': total, 'est': dict(zip(names, est.tolist())), 'var': dict(zip(names, var.tolist()))}
+    #}}}
+
+    @staticmethod
+    def calc_table(path, args): # {{{
+        try:
+            table = numpy.load(path)
+            counts = table['counts']
+            y = table['y'].tolist()
+            names = []
+            name_counts = numpy.zeros((0, len(counts)), dtype=numpy.int64)
+            if 'names' in table.files:
+                names = table['names'].tolist()
+                name_counts = table['name_counts']
+        except Exception as e:
+            return None
+
+        ry = y
+        if 'y' in args:
+            ry = args['y']
+        if ry[0] < y[0] or ry[1] > y[1]:
+            return None
+
+        counts = counts[ry[0] - y[0]:ry[1] - y[0] + 1]
+        if counts.shape[1] > 4096:
+            counts = counts.reshape(len(counts), 4096, 16).sum(axis = 2)
+        hist = counts.sum(axis = 0)
+        name_counts = name_counts[:, ry[0] - y[0]:ry[1] - y[0] + 1].sum(axis = 1).tolist()
+        block_names = dict(zip(names, name_counts))
+        return McChunk.count_rules(args['rules'], hist, int(hist.sum()) + sum(name_counts), block_names)
+    # }}}
+
+    def calc_hist(self, region_list, file_name, args, ret): #{{{
+        src_path = os.path.join(self.path, file_name)
+
+        with McRegion(src_path) as x:
+            table = x.walk(region_list, x.calc_hist, args)
+        return McWorld.merge_count(ret, table)
+    #}}}
+
+    def get_jobs(self, region_list): #{{{
+        jobs = []
+        files = region_list.get_files()
+        if files == None:
+            files = os.listdir(self.path)
+        else:
+            files = [i for i in files if os.path.exists(os.path.join(self.path, i))]
+        for file_name in sorted(files):
+            tmp = file_name.split('.');
+            if len(tmp) != 4 or tmp[3] != 'mca':
+                continue
+            coord = [int(i) for i in tmp[1:3]]
+            file_region = McWorld.get_file_region(coord)
+
+            file_region_list = region_list.match(file_region)
+            if file_region_list == None:
+                continue
+            jobs.append((file_region_list, file_name))
+        return jobs
+    #}}}
+
+    def plan_region(self, region_list, file_name, args, ret): #{{{
+        src_path = os.path.join(self.path, file_name)
+        keep = region_list.mask(McRegion.get_base(src_path))
+        offsets, times = McRegion.read_header(src_path)
+        if 'prune' in args and not McRegion.prune_tags(args['prune']):
+            keep &= ~McRegion.prune_header(offsets, times, args['prune'])
+        present = offsets[:, 0] != 0
+        kept = present & keep
+
+        row = {
+            'file': file_name,
+            'chunks': int(numpy.count_nonzero(present)),
+            'kept': int(numpy.count_nonzero(kept)),
+            'read': int(offsets[kept, 1].sum()) * 4096,
+            'write': 0,
+            'mode': 'calc',
+        }
+        row['dropped'] = row['chunks'] - row['kept']
+        if args['mode'] == 'clear':
+            if not keep.any():
+                row['mode'] = 'skip'
+                row['read'] = 0
+            elif keep.all():
+                row['mode'] = 'copy'
+                row['read'] = os.path.getsize(src_path)
+                row['write'] = row['read']
+            else:
+                row['mode'] = 'partial'
+                row['write'] = row['read'] + 4096 * 2
+
+        count = {'files': 1, 'regions': [row]}
+        for item in ('chunks', 'kept', 'dropped', 'read', 'write'):
+            count[item] = row[item]
+        return McWorld.merge_count(ret, count)
+    #}}}
+
+    def measure(self, jobs, args, limit = 64): #{{{
+        chunks = []
+        regions = []
+        step = max(1, len(jobs) // 8)
+        for region_list, file_name in jobs[::step]:
+            x = McRegion(os.path.join(self.path, file_name))
+            regions.append(x)
+            for index in numpy.flatnonzero(region_list.mask(x.base) & (x.offsets[:, 0] != 0))[:limit // 8 + 1].tolist():
+                chunks.append((x, index))
+            if len(chunks) >= limit:
+                break
+        if len(chunks) == 0:
+            for x in regions:
+                x.close()
+            return None
+
+        size = 0
+        start = time.perf_counter()
+        for x, index in chunks:
+            chunk = x.get_chunk(index = index)
+            if args['mode'] == 'calc':
+                chunk.calc_block(args)
+            else:
+                bytes(chunk.data)
+                try:
+                    chunk.decompress()
+                except Exception as e:
+                    Profile.add('chunks_corrupt')
+            size += int(x.offsets[index, 1]) * 4096
+        wall = time.perf_counter() - start
+
+        for x in regions:
+            x.close()
+        return (len(chunks), size / max(wall, 1e-9))
+    #}}}
+
+    @staticmethod
+    def run_job(profile, call, region_list, file_name, args): #{{{
+        Profile.enabled = profile
+        Profile.reset()
+        count = call(region_list, file_name, args, None)
+        return (count, Profile.snapshot())
+    #}}}
+
+    def walk(self, region_list, call, args, workers = 1, journal = None): #{{{
+        return self.run_jobs(self.get_jobs(region_list), call, args, workers, journal)
+    #}}}
+
+    @staticmethod
+    def select_jobs(jobs, files = None, shard = None): #{{{
+        if files != None:
+            jobs = [job for job in jobs if job[1] in files]
+        if shard != None:
+            jobs = jobs[shard[0]::shard[1]]
+        return jobs
+    #}}}
+
+    @staticmethod
+    def merge_ready(ret, names, pos, results): #{{{
+        while pos < len(names) and names[pos] in results:
+            ret = McWorld.merge_count(ret, results.pop(names[pos]))
+            pos += 1
+        return (ret, pos)
+    #}}}
+
+    def run_jobs(self, jobs, call, args, workers = 1, journal = None): #{{{
+        names = [job[1] for job in jobs]
+        results = {}
+        if journal != None:
+            for file_name in names:
+                if file_name in journal.done:
+                    results[file_name] = journal.done[file_name]
+            jobs = [job for job in jobs if not job[1] in journal.done]
+        ret, pos = McWorld.merge_ready(None, names, 0, results)
+
+        if workers <= 1 or len(jobs) <= 1:
+            for file_region_list, file_name in jobs:
+                count = call(file_region_list, file_name, args, None)
+                if journal != None:
+                    journal.write(file_name, count)
+                results[file_name] = count
+                ret, pos = McWorld.merge_ready(ret, names, pos, results)
+            return ret
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = {}
+            for file_region_list, file_name in jobs:
+                futures[pool.submit(McWorld.run_job, Profile.enabled, call, file_region_list, file_name, args)] = file_name
+            for future in concurrent.futures.as_completed(futures):
+                count, snapshot = future.result()
+                Profile.merge(snapshot)
+                if journal != None:
+                    journal.write(futures[future], count)
+                results[futures[future]] = count
+                ret, pos = McWorld.merge_ready(ret, names, pos, results)
+        return ret
+    #}}}
 
-        x.walk(region_list, x.move_file, {'dst_file': new_file})
-        new_file.write()
+    @staticmethod
+    def list_regions(path): #{{{
+        files = set()
+        if not os.path.isdir(path):
+            return files
+        for file_name in os.listdir(path):
+            tmp = file_name.split('.')
+            if len(tmp) == 4 and tmp[0] == 'r' and tmp[3] == 'mca':
+                files.add(file_name)
+        return files
     #}}}
 
-    def calc_block(self, region_list, file_name, args, ret): #{{{
-        src_path = os.path.join(self.path, file_name)
+    def diff_region(self, region_list, file_name, args, ret): #{{{
+        left_path = os.path.join(self.path, file_name)
+        right_path = os.path.join(args['right'], file_name)
+        left_args = {}
+        right_args = {}
+
+        if os.path.exists(left_path) and os.path.exists(right_path):
+            if 'cache' in args:
+                left_args = {'cached': args['cache'].load(left_path), 'rows': []}
+                right_args = {'cached': args['cache'].load(right_path), 'rows': []}
+            with McRegion(left_path) as x, McRegion(right_path) as y:
+                added, removed, changed, same = x.compare(y, left_args, right_args)
+            if 'cache' in args:
+                args['cache'].store(left_path, left_args['rows'])
+                args['cache'].store(right_path, right_args['rows'])
+        else:
+            empty = (numpy.zeros((1024, 2), dtype=numpy.int64), numpy.zeros(1024, dtype=numpy.int64))
+            left = empty
+            right = empty
+            if os.path.exists(left_path):
+                left = McRegion.read_header(left_path)
+            if os.path.exists(right_path):
+                right = McRegion.read_header(right_path)
+            added, removed, changed, same = McRegion.diff_header(left, right)
+
+        count = {'files': 1, 'same': int(numpy.count_nonzero(same)), 'regions': []}
+        base = McRegion.get_base(file_name)
+        row = {'file': file_name}
+        for item, mask in (('added', added), ('removed', removed), ('changed', changed)):
+            count[item] = int(numpy.count_nonzero(mask))
+            row[item] = [[base[0] + i % 32, base[1] + i // 32] for i in numpy.flatnonzero(mask).tolist()]
+        if count['added'] + count['removed'] + count['changed'] > 0:
+            count['regions'].append(row)
+        return McWorld.merge_count(ret, count)
+    #}}}
 
-        x = McRegion(src_path)
-        count = x.walk(region_list, x.calc_block, args)
-        if ret == None:
-            return count
-        for item in ret:
-            if item in count:
-                count[item] += ret[item]
-            else:
-                count[item] = ret[item]
-        return count
+    def index_region(self, region_list, file_name, args, ret): #{{{
+        src_path = os.path.join(self.path, file_name)
+        stat = os.stat(src_path)
+        with McRegion(src_path) as x:
+            table = x.chunk_table()
+            records = numpy.zeros(len(table['index']), dtype=WorldIndex.CHUNK_DTYPE)
+            records['x'] = x.base[0] + table['index'] % 32
+            records['z'] = x.base[1] + table['index'] // 32
+            for item in ('offset', 'length', 'timestamp', 'index', 'sectors', 'compression'):
+                records[item] = table[item]
+            records['sections'] = -1
+            for i in numpy.flatnonzero(table['compression'] & 0x80).tolist():
+                external = x.get_external(int(table['index'][i]))
+                if os.path.exists(external):
+                    records['length'][i] += os.path.getsize(external)
+            for i, index in enumerate(table['index'].tolist()):
+                if args.get('hash'):
+                    records['hash'][i] = bytes.fromhex(x.get_hash(index, {}))
+                if args.get('sections'):
+                    try:
+                        records['sections'][i] = len(x.get_chunk(index = index).get_sections())
+                    except Exception as e:
+                        Profile.add('chunks_corrupt')
+        base = McRegion.get_base(src_path)
+        region = (base[0] // 32, base[1] // 32, stat.st_mtime_ns, stat.st_size)
+        return McWorld.merge_count(ret, {'index': [(region, records)]})
     #}}}
 
-    def walk(self, region_list, call, args): #{{{
-        ret = None
-        files = os.listdir(self.path)
-        for file_name in files:
-            tmp = file_name.split('.');
-            if len(tmp) != 4 or tmp[3] != 'mca':
-                continue
-            coord = [int(i) for i in tmp[1:3]]
-            file_region = McWorld.get_file_region(coord)
+    def get_index(self, path = None): #{{{
+        index = WorldIndex(path or os.path.join(self.path, '.index'))
+        if not index.load():
+            return None
+        return index
+    #}}}
 
-            file_region_list = region_list.match(file_region)
-            if file_region_list == None:
-                continue
-            ret = call(file_region_list, file_name, args, ret)
-        return ret
+    def build_index(self, args, workers = 1, path = None): #{{{
+        index = WorldIndex(path or os.path.join(self.path, '.index'))
+        meta = {'version': WorldIndex.VERSION, 'hash': bool(args.get('hash')), 'sections': bool(args.get('sections'))}
+        old = {}
+        if index.load() and index.meta == meta:
+            for row in index.regions.tolist():
+                old[(row[0], row[1])] = row
+
+        jobs = []
+        kept = []
+        for file_name in sorted(McWorld.list_regions(self.path), key = McRegion.get_base):
+            base = McRegion.get_base(file_name)
+            key = (base[0] // 32, base[1] // 32)
+            stat = os.stat(os.path.join(self.path, file_name))
+            row = old.get(key)
+            if row != None and row[2] == stat.st_mtime_ns and row[3] == stat.st_size:
+                kept.append((key + (row[2], row[3]), numpy.array(index.chunks[row[4]:row[4] + row[5]])))
+            else:
+                jobs.append((None, file_name))
+
+        count = self.run_jobs(jobs, self.index_region, args, workers)
+        built = []
+        if count != None:
+            built = count['index']
+        items = sorted(kept + built, key = lambda item: (item[0][1], item[0][0]))
+
+        regions = numpy.zeros(len(items), dtype=WorldIndex.REGION_DTYPE)
+        start = 0
+        for i, (region, records) in enumerate(items):
+            regions[i] = region + (start, len(records))
+            start += len(records)
+        chunks = numpy.zeros(0, dtype=WorldIndex.CHUNK_DTYPE)
+        if len(items) > 0:
+            chunks = numpy.concatenate([records for region, records in items])
+
+        index.regions = None
+        index.chunks = None
+        index.save(meta, regions, chunks)
+        return {'regions': len(items), 'updated': len(built), 'kept': len(kept), 'chunks': len(chunks)}
     #}}}
 
-    def compare(self, right): #{{{
-        files = os.listdir(self.path)
-        for McRegion in files:
-            src_file = os.path.join(self.path, McRegion)
-            dst_file = os.path.join(right.path, McRegion)
+    def compact_region(self, region_list, file_name, args, ret): #{{{
+        src_path = os.path.join(self.path, file_name)
+        tmp_path = os.path.join(self.path, '.compact', file_name)
+        size = os.path.getsize(src_path)
+
+        with McRegion(src_path) as x:
+            present = numpy.flatnonzero(x.offsets[:, 0] != 0)
+            live = int(x.offsets[present, 1].sum())
+            row = {'file': file_name, 'chunks': len(present), 'size': size, 'compact': size}
+            packed = size <= (live + 2) * 4096
+            if args['order'] == 'offset':
+                present = present[numpy.argsort(x.offsets[present, 0], kind = 'stable')]
+            elif packed:
+                packed = bool((numpy.diff(x.offsets[present, 0]) > 0).all())
+            if 'compress' in args:
+                packed = False
+
+            if not packed:
+                os.makedirs(os.path.dirname(tmp_path), exist_ok = True)
+                new_file = McRegion(tmp_path, True)
+                new_file.reserve(live)
+                region_args = dict(args)
+                region_args['dst_file'] = new_file
+                moved = {}
+                for index in present.tolist():
+                    moved = x.move_file(index, region_args, moved)
+                for item in ('before', 'after', '__corrupt__'):
+                    if item in moved:
+                        row[item] = moved[item]
+                new_file.write()
+                new_file.fh.flush()
+                os.fsync(new_file.fh.fileno())
+                new_file.close()
+                row['compact'] = os.path.getsize(tmp_path)
+
+        if not packed:
+            for name in new_file.external:
+                os.replace(os.path.join(self.path, '.compact', name), os.path.join(self.path, name))
+            os.replace(tmp_path, src_path)
+            for name in x.external - new_file.external:
+                if os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
+        row['reclaimed'] = row['size'] - row['compact']
+
+        count = {'files': 1, 'regions': [row]}
+        for item in ('chunks', 'size', 'compact', 'reclaimed', 'before', 'after'):
+            if item in row:
+                count[item] = row[item]
+        if '__corrupt__' in row:
+            count['__corrupt__'] = row.pop('__corrupt__')
+        return McWorld.merge_count(ret, count)
+    #}}}
 
-            if not os.path.exists(dst_file):
-                print('缺少：' + McRegion)
+    def compact(self, args, workers = 1): #{{{
+        files = McWorld.list_regions(self.path)
+        count = self.run_jobs([(None, file_name) for file_name in sorted(files)], self.compact_region, args, workers)
+        tmp_dir = os.path.join(self.path, '.compact')
+        if os.path.isdir(tmp_dir) and len(os.listdir(tmp_dir)) == 0:
+            os.rmdir(tmp_dir)
+        return count
+    #}}}
 
-            x = McRegion(src_file)
-            y = McRegion(dst_file)
-            if x.compare(y):
-                print('相同：' + McRegion)
-            else:
-                print('不同：' + McRegion)
+    def compare(self, right, args = None, workers = 1): #{{{
+        args = dict(args or {})
+        args['right'] = right.path
+        files = McWorld.list_regions(self.path) | McWorld.list_regions(right.path)
+        return self.run_jobs([(None, file_name) for file_name in sorted(files)], self.diff_region, args, workers)
     #}}}
 
  #}}}
@@ -563,12 +2573,107 @@ class App: # {{{
             config['src'] = os.path.join(basedir, config['src'])
         if 'dst' in config:
             config['dst'] = os.path.join(basedir, config['dst'])
+        if 'cache' in config:
+            config['cache'] = os.path.join(basedir, config['cache'])
 
         return config
     # }}}
 
+    def get_prune(self, config): # {{{
+        if not 'prune' in config:
+            return None
+        prune = {}
+        try:
+            if 'inhabited' in config['prune']:
+                prune['inhabited'] = int(config['prune']['inhabited'])
+            if 'before' in config['prune']:
+                before = config['prune']['before']
+                if isinstance(before, str):
+                    fmt = '%Y-%m-%d %H:%M:%S' if before.find(':') != -1 else '%Y-%m-%d'
+                    before = time.mktime(time.strptime(before, fmt))
+                prune['before'] = int(before)
+            if config['prune'].get('empty'):
+                prune['empty'] = True
+        except (ValueError, TypeError, AttributeError) as e:
+            return False
+        if len(prune) <= 0:
+            return False
+        return prune
+    # }}}
+
+    def get_journal(self, config, args): # {{{
+        if not 'journal' in self.cfg:
+            return None
+        journal = Journal(self.cfg['journal'], Journal.get_key(self.cmd, config, args))
+        if 'resume' in self.cfg:
+            if not journal.load():
+                print('检查点文件与当前任务不符')
+                return False
+            print('已完成的区域文件: %d' % len(journal.done))
+        journal.open('resume' in self.cfg)
+        return journal
+    # }}}
+
+    def get_regions(self): # {{{
+        if not 'regions' in self.cfg:
+            return None
+        value = self.cfg['regions']
+        if value.startswith('@'):
+            try:
+                with open(value[1:], 'r', encoding = 'utf-8') as f:
+                    value = f.read().split()
+            except OSError as e:
+                return False
+        else:
+            value = value.split(',')
+        return set(os.path.basename(i.strip()) for i in value if i.strip() != '')
+    # }}}
+
+    @staticmethod
+    def print_corrupt(count): # {{{
+        if '__corrupt__' in count:
+            print('损坏的区块: %d' % len(count['__corrupt__']))
+    # }}}
+
+    def get_threads(self, config, args): # {{{
+        for item in ('threads', 'depth'):
+            if item in self.cfg:
+                args[item] = self.cfg[item]
+            elif item in config:
+                args[item] = int(config[item])
+        return args
+    # }}}
+
+    def get_workers(self, config): # {{{
+        workers = 1
+        if 'workers' in self.cfg:
+            workers = self.cfg['workers']
+        elif 'workers' in config:
+            workers = int(config['workers'])
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+        return workers
+    # }}}
+
+    def get_compress(self): # {{{
+        if not 'codec' in self.cfg:
+            if 'level' in self.cfg:
+                if not McChunk.check_level('zlib', self.cfg['level']):
+                    return False
+                return ('zlib', self.cfg['level'])
+            return None
+        if not self.cfg['codec'] in McChunk.COMPRESS:
+            return False
+        if self.cfg['codec'] == 'lz4' and (lz4 == None or xxhash == None):
+            return False
+        if 'level' in self.cfg and not McChunk.check_level(self.cfg['codec'], self.cfg['level']):
+            return False
+        return (self.cfg['codec'], self.cfg.get('level'))
+    # }}}
+
     def __init__(self): # {{{
         self.cmd = ''
+        self.args = []
         self.get_param()
     # }}}
 
@@ -584,8 +2689,9 @@ class App: # {{{
                 App.print_help()
                 sys.exit()
 
-            opts, args = getopt.getopt(sys.argv[2:], 'C:F:D:O:c:d:b:', ['config=','file=','dir=','output=','chunk','compress','block'])
+            opts, args = getopt.gnu_getopt(sys.argv[2:], 'C:F:D:O:c:d:b:P:j:H:R:', ['config=','file=','dir=','output=','chunk','compress','block','path=','workers=','rebuild','histogram=','data','profile','profile-json=','cprofile=','dry-run','threads=','depth=','right=','json','cache=','order=','codec=','level=','csv','grid=','top=','rule=','journal=','resume','hash','sections','query=','index=','sample=','seed=','shard=','regions=','partial=','partial-grid','measure'])
 
+            self.args = args
             self.cfg = {}
             for opt, value in opts:
                 if opt in ('-C', '--config'):
@@ -602,8 +2708,79 @@ class App: # {{{
                     self.cfg['block'] = value
                 elif opt in ('-d', '--compress'):
                     self.cfg['compress'] = value
-
-        except getopt.GetoptError as e:
+                elif opt in ('-P', '--path'):
+                    self.cfg['path'] = value
+                elif opt in ('-j', '--workers'):
+                    self.cfg['workers'] = int(value)
+                elif opt == '--rebuild':
+                    self.cfg['rebuild'] = True
+                elif opt in ('-H', '--histogram'):
+                    self.cfg['histogram'] = value
+                elif opt == '--data':
+                    self.cfg['data'] = True
+                elif opt == '--profile':
+                    self.cfg['profile'] = True
+                elif opt == '--profile-json':
+                    self.cfg['profile_json'] = value
+                elif opt == '--cprofile':
+                    self.cfg['cprofile'] = value
+                elif opt == '--dry-run':
+                    self.cfg['dry_run'] = True
+                elif opt == '--measure':
+                    self.cfg['measure'] = True
+                elif opt == '--threads':
+                    self.cfg['threads'] = int(value)
+                elif opt == '--depth':
+                    self.cfg['depth'] = int(value)
+                elif opt in ('-R', '--right'):
+                    self.cfg['right'] = value
+                elif opt == '--json':
+                    self.cfg['json'] = True
+                elif opt == '--csv':
+                    self.cfg['csv'] = True
+                elif opt == '--grid':
+                    self.cfg['grid'] = value
+                elif opt == '--top':
+                    self.cfg['top'] = int(value)
+                elif opt == '--rule':
+                    self.cfg['rule'] = value
+                elif opt == '--journal':
+                    self.cfg['journal'] = value
+                elif opt == '--resume':
+                    self.cfg['resume'] = True
+                elif opt == '--hash':
+                    self.cfg['hash'] = True
+                elif opt == '--sections':
+                    self.cfg['sections'] = True
+                elif opt == '--query':
+                    self.cfg['query'] = value
+                elif opt == '--index':
+                    self.cfg['index'] = value
+                elif opt == '--sample':
+                    self.cfg['sample'] = float(value)
+                elif opt == '--seed':
+                    self.cfg['seed'] = int(value)
+                elif opt == '--shard':
+                    shard = tuple(int(i) for i in value.split('/'))
+                    if len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+                        raise ValueError(value)
+                    self.cfg['shard'] = shard
+                elif opt == '--regions':
+                    self.cfg['regions'] = value
+                elif opt == '--partial':
+                    self.cfg['partial'] = value
+                elif opt == '--partial-grid':
+                    self.cfg['partial_grid'] = True
+                elif opt == '--cache':
+                    self.cfg['cache'] = value
+                elif opt == '--order':
+                    self.cfg['order'] = value
+                elif opt == '--codec':
+                    self.cfg['codec'] = value
+                elif opt == '--level':
+                    self.cfg['level'] = int(value)
+
+        except (getopt.GetoptError, ValueError) as e:
             App.print_help()
             sys.exit()
     # }}}
@@ -613,7 +2790,13 @@ class App: # {{{
             x = McRegion(path)
             coord = McRegion.get_coord(self.cfg['chunk'])
             chunk = x.get_chunk(coord = coord)
-            chunk.print_nbt(out_file)
+            if chunk == None:
+                print('区块不存在')
+            elif 'json' in self.cfg:
+                chunk.print_json(out_file, self.cfg.get('path'))
+            else:
+                chunk.print_nbt(out_file, self.cfg.get('path'))
+            x.close()
         else:
             in_file = open(path, 'rb')
             data = in_file.read()
@@ -623,6 +2806,36 @@ class App: # {{{
             if 'compress' in self.cfg:
                 compress = self.cfg['compress']
 
+            if 'json' in self.cfg:
+                raw = McRegion.decode_raw(data, compress)
+                found = None
+                if raw != None:
+                    try:
+                        found = NbtScanner(raw).dump_json(out_file or sys.stdout, self.cfg.get('path'))
+                    except Exception as e:
+                        raw = None
+                if raw == None:
+                    print('文件格式错误')
+                elif not found:
+                    print('路径不存在')
+                return
+
+            if 'path' in self.cfg:
+                raw = McRegion.decode_raw(data, compress)
+                tag = None
+                if raw != None:
+                    try:
+                        tag = NbtScanner(raw).get_tag(self.cfg['path'])
+                    except Exception as e:
+                        raw = None
+                if raw == None:
+                    print('文件格式错误')
+                elif tag == None:
+                    print('路径不存在')
+                else:
+                    print(tag.pretty_tree(), file=out_file)
+                return
+
             nbtfile = McRegion.decode_nbt(data, compress)
             if nbtfile != None:
                 print(nbtfile.pretty_tree(), file=out_file)
@@ -639,12 +2852,14 @@ class App: # {{{
             print('参数错误')
             return
 
-        x = McWorld(path)
-        chunk = x.get_chunk(coord = coord)
-        if chunk != None:
-            chunk.print_nbt(out_file)
-        else:
-            print('区块不存在')
+        with McWorld(path) as x:
+            chunk = x.get_chunk(coord = coord)
+            if chunk == None:
+                print('区块不存在')
+            elif 'json' in self.cfg:
+                chunk.print_json(out_file, self.cfg.get('path'))
+            else:
+                chunk.print_nbt(out_file, self.cfg.get('path'))
     # }}}
 
     def do_nbt(self): # {{{
@@ -653,9 +2868,9 @@ class App: # {{{
             out_file = open(self.cfg['output'],'w+')
 
         if 'file' in self.cfg:
-            return self.export_file_nbt(self.cfg['file'], out_file)
+            self.export_file_nbt(self.cfg['file'], out_file)
         elif 'dir' in self.cfg:
-            return self.export_dir_nbt(self.cfg['dir'], out_file)
+            self.export_dir_nbt(self.cfg['dir'], out_file)
         else:
             print('参数错误')
 
@@ -664,18 +2879,37 @@ class App: # {{{
     # }}}
 
     def do_list_chunks(self): # {{{
-        if not 'file' in self.cfg:
+        if 'file' in self.cfg:
+            files = [self.cfg['file']]
+        elif 'dir' in self.cfg:
+            files = [os.path.join(self.cfg['dir'], i) for i in sorted(McWorld.list_regions(self.cfg['dir']), key = McRegion.get_base)]
+        else:
             print('参数错误')
             return
 
-        out_file = None
+        out_file = sys.stdout
         if 'output' in self.cfg:
-            out_file = open(self.cfg['output'],'w+')
-
-        x = McRegion(self.cfg['file'])
-        x.show_chunks(out_file)
-
-        if out_file != None:
+            out_file = open(self.cfg['output'], 'w+', newline = '')
+
+        writer = None
+        if 'csv' in self.cfg:
+            writer = csv.DictWriter(out_file, McRegion.CHUNK_FIELDS)
+            writer.writeheader()
+
+        for path in files:
+            with McRegion(path) as x:
+                if writer != None:
+                    writer.writerows(x.iter_chunks())
+                elif 'json' in self.cfg:
+                    for row in x.iter_chunks():
+                        out_file.write(json.dumps(row))
+                        out_file.write('\n')
+                else:
+                    if 'dir' in self.cfg:
+                        print(os.path.basename(path), file=out_file)
+                    x.show_chunks(out_file)
+
+        if out_file != sys.stdout:
             out_file.close()
     # }}}
 
@@ -696,6 +2930,17 @@ class App: # {{{
         region_list = RegionList()
         region_list.add(region_list = config['area'], div = 16)
 
+        prune = self.get_prune(config)
+        if prune == False:
+            print('配置文件错误')
+            return
+
+        if 'dry_run' in self.cfg:
+            args = {'mode': 'clear'}
+            if prune != None:
+                args['prune'] = prune
+            return self.do_plan(config, region_list, args)
+
         dst = config['dst']
         if os.path.exists(dst) and not os.path.isdir(dst):
             print('路径不是目录')
@@ -703,31 +2948,69 @@ class App: # {{{
         if not os.path.exists(dst):
             os.makedirs(dst)
 
-        world = McWorld(config['src'])
-        world.walk(region_list, world.move_data, {'dst': config['dst']})
-    # }}}
-
-    def do_calc_block(self): # {{{
-        config = self.load_cfg()
-        if config == None:
-            print('配置文件错误')
+        args = {'dst': config['dst']}
+        if prune != None:
+            args['prune'] = prune
+        compress = self.get_compress()
+        if compress == False:
+            print('压缩格式或压缩等级错误')
             return
+        elif compress != None:
+            args['compress'] = compress
 
-        if not 'src' in config:
-            print('配置文件错误')
+        journal = self.get_journal(config, {'compress': args.get('compress'), 'prune': prune})
+        if journal == False:
             return
 
-        if not 'area' in config or len(config['area']) <= 0:
-            print('配置文件错误')
-            returl
+        world = McWorld(config['src'])
+        count = world.walk(region_list, world.move_data, args, self.get_workers(config), journal)
+        if journal != None:
+            journal.close()
+        if count != None:
+            print('文件: %d 区块: %d' % (count['files'], count['chunks']))
+            App.print_corrupt(count)
+            if prune != None:
+                print('删除未使用的区块: %d' % count.get('pruned', 0))
+            if 'before' in count:
+                print('压缩前: %.2fMB 压缩后: %.2fMB (%+.1f%%)' % (count['before'] / 1048576, count['after'] / 1048576, (count['after'] - count['before']) * 100 / max(count['before'], 1)))
+    # }}}
 
-        region_list = RegionList()
-        region_list.add(region_list = config['area'], div = 16)
+    @staticmethod
+    def print_count(config, count): # {{{
+        len1 = 0
+        for item in config['calc']:
+            if item['name'] in count:
+                name = item['name']
+                count[name] = format(count[name], ',')
+                if len(count[name]) > len1:
+                    len1 = len(count[name])
+
+        format_str = '%%%ds %%s' % (len1)
+        for item in config['calc']:
+            if item['name'] in count:
+                print(format_str % (count[item['name']], item['name']))
+    # }}}
+
+    @staticmethod
+    def print_sample(config, count): # {{{
+        sample = count.get('__sample__', {'n': 0, 'N': 0, 'est': {}, 'var': {}})
+        rows = []
+        for item in config['calc']:
+            name = item['name']
+            if name in sample['est']:
+                rows.append((format(int(round(sample['est'][name])), ','), format(int(round(1.96 * sample['var'][name] ** 0.5)), ','), name))
+        len1 = max([len(row[0]) for row in rows] + [0])
+        len2 = max([len(row[1]) for row in rows] + [0])
+        format_str = '%%%ds ± %%%ds %%s' % (len1, len2)
+        for row in rows:
+            print(format_str % row)
+        print('抽样区块: %d / %d（%.2f%%），95%%置信区间' % (sample['n'], sample['N'], sample['n'] * 100 / max(sample['N'], 1)))
+    # }}}
 
+    def get_calc_args(self, config): # {{{
         args = {}
         if not 'calc' in config:
-            print('配置文件错误')
-            return
+            return None
 
         if 'y' in config:
             y = RegionList.format_range(config['y'])
@@ -744,28 +3027,419 @@ class App: # {{{
                 args['calc'][item['name']]['exclude'] = set(item['exclude'])
 
         if len(args['calc']) <= 0:
+            return None
+        args['rules'] = McChunk.compile_calc(args['calc'])
+        return args
+    # }}}
+
+    def do_plan(self, config, region_list, args): # {{{
+        workers = self.get_workers(config)
+        world = McWorld(config['src'])
+        count = world.walk(region_list, world.plan_region, args, workers)
+        if count == None:
+            print('没有需要处理的区域文件')
+            return
+
+        print('%-16s %8s %8s %8s %12s %12s %8s' % ('区域文件', '区块', '保留', '丢弃', '读取(MB)', '写入(MB)', '方式'))
+        for row in sorted(count['regions'], key = lambda row: row['file']):
+            print('%-16s %8d %8d %8d %12.2f %12.2f %8s' % (row['file'], row['chunks'], row['kept'], row['dropped'], row['read'] / 1048576, row['write'] / 1048576, row['mode']))
+        print('合计: 文件 %d 区块 %d 保留 %d 丢弃 %d 读取 %.2fMB 写入 %.2fMB' % (count['files'], count['chunks'], count['kept'], count['dropped'], count['read'] / 1048576, count['write'] / 1048576))
+
+        if not 'measure' in self.cfg:
+            return
+        sample = world.measure(world.get_jobs(region_list), args)
+        if sample != None:
+            samples, rate = sample
+            print('预计耗时: %.1fs（%d 个样本区块，%.2fMB/s，%d 个进程）' % (count['read'] / rate / workers, samples, rate / 1048576, workers))
+    # }}}
+
+    def do_calc_block(self): # {{{
+        config = self.load_cfg()
+        if config == None:
+            print('配置文件错误')
+            return
+
+        args = self.get_calc_args(config)
+        if args == None:
+            print('配置文件错误')
+            return
+
+        if 'histogram' in self.cfg:
+            count = McWorld.calc_table(self.cfg['histogram'], args)
+            if count == None:
+                print('统计表错误')
+                return
+            return App.print_count(config, count)
+
+        if not 'src' in config:
+            print('配置文件错误')
+            return
+
+        if not 'area' in config or len(config['area']) <= 0:
             print('配置文件错误')
             return
 
+        region_list = RegionList()
+        region_list.add(region_list = config['area'], div = 16)
+
+        if 'dry_run' in self.cfg:
+            args['mode'] = 'calc'
+            return self.do_plan(config, region_list, args)
+
+        if 'cache' in config:
+            cache_size = 1000000
+            if 'cache_size' in config:
+                cache_size = int(config['cache_size'])
+            args['cache'] = CalcCache(config['cache'], CalcCache.get_key(args), cache_size)
+            if 'rebuild' in self.cfg:
+                args['cache'].rebuild()
+
+        if 'grid' in self.cfg or 'top' in self.cfg or 'partial_grid' in self.cfg:
+            args['grid'] = True
+            if ChunkGrid(args['rules'][0], {}).get_rule(self.cfg.get('rule')) < 0:
+                print('统计项目不存在')
+                return
+
+        if 'sample' in self.cfg:
+            if not 0 < self.cfg['sample'] <= 1:
+                print('参数错误')
+                return
+            args['sample'] = self.cfg['sample']
+            args['seed'] = self.cfg.get('seed', 0)
+
+        files = self.get_regions()
+        if files == False:
+            print('区域文件列表错误')
+            return
+        if 'partial' in self.cfg:
+            args['stats'] = True
+
+        journal = self.get_journal(config, {'grid': 'grid' in args, 'sample': args.get('sample'), 'seed': args.get('seed'),
+            'shard': self.cfg.get('shard'), 'regions': sorted(files) if files != None else None, 'stats': 'stats' in args})
+        if journal == False:
+            return
 
+        self.get_threads(config, args)
         world = McWorld(config['src'])
-        count = world.walk(region_list, world.calc_block, args)
+        jobs = McWorld.select_jobs(world.get_jobs(region_list), files, self.cfg.get('shard'))
+        count = world.run_jobs(jobs, world.calc_block, args, self.get_workers(config), journal)
+        if journal != None:
+            journal.close()
+        if count == None:
+            count = {}
+
+        if 'cache' in args:
+            args['cache'].evict()
+            args['cache'].close()
+
+        if 'partial' in self.cfg:
+            meta = {'key': CalcCache.get_key(args), 'names': args['rules'][0], 'calc': config['calc'], 'y': list(args['y']) if 'y' in args else None,
+                'sample': args.get('sample'), 'seed': args.get('seed'), 'shard': self.cfg.get('shard'), 'regions': [job[1] for job in jobs]}
+            if 'grid' in args:
+                count.setdefault('__grid__', {})
+            CalcPartial(self.cfg['partial']).save(meta, count)
+            print('部分结果: %s（区域文件 %d）' % (self.cfg['partial'], len(jobs)))
+        count.pop('__stats__', None)
+        self.print_calc(config, args['rules'][0], count)
+    # }}}
 
-        len1 = 0
-        for item in config['calc']:
-            if item['name'] in count:
-                name = item['name']
-                count[name] = format(count[name], ',')
-                if len(count[name]) > len1:
-                    len1 = len(count[name])
+    def print_calc(self, config, names, count): # {{{
+        grid = None
+        if 'grid' in self.cfg or 'top' in self.cfg:
+            grid = ChunkGrid(names, count.pop('__grid__', {}))
+        if '__sample__' in count:
+            App.print_sample(config, count)
+        else:
+            App.print_count(config, count)
+        App.print_corrupt(count)
+        if grid == None:
+            return
 
-        format_str = '%%%ds %%s' % (len1)
-        for item in config['calc']:
-            if item['name'] in count:
-                print(format_str % (count[item['name']], item['name']))
+        rule = grid.get_rule(self.cfg.get('rule'))
+        if 'grid' in self.cfg:
+            if grid.save(self.cfg['grid'], rule):
+                print('区块网格: %d x %d 起点 (%d, %d) 区块: %d' % (grid.width, grid.height, grid.x0, grid.z0, len(grid.x)))
+            else:
+                print('区块分布过于分散（%d x %d，区块 %d），无法保存为npy或png，请使用csv或npz' % (grid.width, grid.height, len(grid.x)))
+        if 'top' in self.cfg:
+            print('%s 最多的区块:' % grid.names[rule])
+            for x, z, values in grid.top(rule, self.cfg['top']):
+                print('  (%d,%d) 方块 (%d,%d) %s' % (x, z, x * 16, z * 16, ' '.join('%s=%s' % (name, format(value, ',')) for name, value in zip(grid.names, values))))
+    # }}}
+
+    def do_histogram(self): # {{{
+        config = self.load_cfg()
+        if config == None:
+            print('配置文件错误')
+            return
+
+        if not 'src' in config:
+            print('配置文件错误')
+            return
+
+        if not 'area' in config or len(config['area']) <= 0:
+            print('配置文件错误')
+            return
+
+        if not 'output' in self.cfg:
+            print('参数错误')
+            return
+
+        region_list = RegionList()
+        region_list.add(region_list = config['area'], div = 16)
+
+        args = {'y': [-64, 319], 'width': 4096}
+        if 'y' in config:
+            args['y'] = RegionList.format_range(config['y'])
+        if 'data' in self.cfg:
+            args['width'] = 4096 * 16
+
+        self.get_threads(config, args)
+        world = McWorld(config['src'])
+        ret = world.walk(region_list, world.calc_hist, args, self.get_workers(config))
+        if ret is None:
+            ret = {'ids': McChunk.hist_table(args), 'names': {}}
+        ret['ids'] = McChunk.dense_hist(ret['ids'], args)
+
+        names = sorted(ret['names'])
+        name_counts = numpy.zeros((len(names), len(ret['ids'])), dtype=numpy.int64)
+        for i, name in enumerate(names):
+            name_counts[i] = ret['names'][name]
+
+        with open(self.cfg['output'], 'wb') as out_file:
+            numpy.savez_compressed(out_file, counts = ret['ids'], y = numpy.array(args['y']), names = numpy.array(names, dtype=str), name_counts = name_counts)
+        print('方块总数: %s' % format(int(ret['ids'].sum() + name_counts.sum()), ','))
+    # }}}
+
+    def do_diff(self): # {{{
+        if not 'dir' in self.cfg or not 'right' in self.cfg:
+            print('参数错误')
+            return
+
+        for path in (self.cfg['dir'], self.cfg['right']):
+            if not os.path.isdir(path):
+                print('路径不是目录')
+                return
+
+        args = {}
+        if 'cache' in self.cfg:
+            args['cache'] = HashCache(self.cfg['cache'])
+
+        left = McWorld(self.cfg['dir'])
+        right = McWorld(self.cfg['right'])
+        count = left.compare(right, args, self.get_workers({}))
+        if count == None:
+            count = {'files': 0, 'added': 0, 'removed': 0, 'changed': 0, 'same': 0, 'regions': []}
+        count['regions'].sort(key = lambda row: row['file'])
+
+        if 'cache' in args:
+            args['cache'].evict()
+            args['cache'].close()
+
+        out_file = None
+        if 'output' in self.cfg:
+            out_file = open(self.cfg['output'], 'w+')
+
+        if 'json' in self.cfg:
+            json.dump(count, out_file or sys.stdout)
+            print(file=out_file)
+        else:
+            for row in count['regions']:
+                print('%s 新增: %d 删除: %d 修改: %d' % (row['file'], len(row['added']), len(row['removed']), len(row['changed'])), file=out_file)
+                for item, mark in (('added', '+'), ('removed', '-'), ('changed', '*')):
+                    for coord in row[item]:
+                        print('  %s (%d,%d)' % (mark, coord[0], coord[1]), file=out_file)
+            print('文件: %d 新增: %d 删除: %d 修改: %d 相同: %d' % (count['files'], count['added'], count['removed'], count['changed'], count['same']), file=out_file)
+
+        if out_file != None:
+            out_file.close()
+    # }}}
+
+    def do_compact(self): # {{{
+        if not 'dir' in self.cfg:
+            print('参数错误')
+            return
+        if not os.path.isdir(self.cfg['dir']):
+            print('路径不是目录')
+            return
+
+        args = {'order': self.cfg.get('order', 'coord')}
+        if not args['order'] in ('coord', 'offset'):
+            print('参数错误')
+            return
+
+        world = McWorld(self.cfg['dir'])
+        count = world.compact(args, self.get_workers({}))
+        if count == None:
+            print('没有需要处理的区域文件')
+            return
+
+        print('%-16s %8s %12s %12s %12s' % ('区域文件', '区块', '原大小(KB)', '整理后(KB)', '回收(KB)'))
+        for row in sorted(count['regions'], key = lambda row: row['file']):
+            print('%-16s %8d %12d %12d %12d' % (row['file'], row['chunks'], row['size'] // 1024, row['compact'] // 1024, row['reclaimed'] // 1024))
+        print('合计: 文件 %d 区块 %d 原大小 %.2fMB 整理后 %.2fMB 回收 %.2fMB' % (count['files'], count['chunks'], count['size'] / 1048576, count['compact'] / 1048576, count['reclaimed'] / 1048576))
+        App.print_corrupt(count)
+    # }}}
+
+    def do_recompress(self): # {{{
+        if not 'dir' in self.cfg:
+            print('参数错误')
+            return
+        if not os.path.isdir(self.cfg['dir']):
+            print('路径不是目录')
+            return
+
+        compress = self.get_compress()
+        if compress == None or compress == False:
+            print('压缩格式或压缩等级错误')
+            return
+
+        world = McWorld(self.cfg['dir'])
+        count = world.compact({'order': self.cfg.get('order', 'coord'), 'compress': compress}, self.get_workers({}))
+        if count == None:
+            print('没有需要处理的区域文件')
+            return
+
+        print('%-16s %8s %12s %12s %12s %12s' % ('区域文件', '区块', '压缩前(KB)', '压缩后(KB)', '原大小(KB)', '新大小(KB)'))
+        for row in sorted(count['regions'], key = lambda row: row['file']):
+            print('%-16s %8d %12d %12d %12d %12d' % (row['file'], row['chunks'], row.get('before', 0) // 1024, row.get('after', 0) // 1024, row['size'] // 1024, row['compact'] // 1024))
+        before = count.get('before', 0)
+        after = count.get('after', 0)
+        print('合计: 文件 %d 区块 %d 压缩前 %.2fMB 压缩后 %.2fMB (%+.1f%%) 文件大小 %.2fMB => %.2fMB' % (count['files'], count['chunks'], before / 1048576, after / 1048576, (after - before) * 100 / max(before, 1), count['size'] / 1048576, count['compact'] / 1048576))
+        App.print_corrupt(count)
+    # }}}
+
+    def do_index(self): # {{{
+        if not 'dir' in self.cfg:
+            print('参数错误')
+            return
+        if not os.path.isdir(self.cfg['dir']):
+            print('路径不是目录')
+            return
+
+        world = McWorld(self.cfg['dir'])
+        if not 'query' in self.cfg:
+            args = {'hash': 'hash' in self.cfg, 'sections': 'sections' in self.cfg}
+            count = world.build_index(args, self.get_workers({}), self.cfg.get('index'))
+            print('区域文件: %d 更新: %d 未变化: %d 区块: %d' % (count['regions'], count['updated'], count['kept'], count['chunks']))
+            return
+
+        index = world.get_index(self.cfg.get('index'))
+        if index == None:
+            print('索引不存在，请先运行index命令')
+            return
+
+        region_list = None
+        if 'config' in self.cfg:
+            config = self.load_cfg()
+            if config == None or not 'area' in config or len(config['area']) <= 0:
+                print('配置文件错误')
+                return
+            region_list = RegionList()
+            region_list.add(region_list = config['area'], div = 16)
+
+        query = self.cfg['query']
+        if query == 'coverage':
+            ret = index.coverage(region_list)
+        elif query == 'age':
+            ret = index.age(region_list)
+        elif query == 'size':
+            ret = index.size(region_list, self.cfg.get('top', 10))
+        else:
+            print('参数错误')
+            return
+
+        if 'json' in self.cfg:
+            print(json.dumps(ret, ensure_ascii = False))
+        elif query == 'coverage':
+            print('区域文件: %d（完整 %d） 区块: %d' % (ret['regions'], ret['full_regions'], ret['chunks']))
+            if 'x' in ret:
+                print('区块范围: x %d ~ %d z %d ~ %d 涉及区域文件: %d' % (ret['x'][0], ret['x'][1], ret['z'][0], ret['z'][1], ret['touched_regions']))
+        elif query == 'age':
+            print('区块: %d' % ret['chunks'])
+            if 'oldest' in ret:
+                print('最早: %s 最新: %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ret['oldest'])), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ret['newest']))))
+            for month in ret['months']:
+                print('%s %10d' % (month, ret['months'][month]))
+        else:
+            print('区块: %d 数据: %.2fMB 扇区: %.2fMB 区域文件: %d（%.2fMB） 外部区块: %d' % (ret['chunks'], ret['bytes'] / 1048576, ret['sectors'] * 4096 / 1048576, ret['regions'], ret['files'] / 1048576, ret['external']))
+            for value in ret['compression']:
+                print('压缩格式 %s: %d' % (value, ret['compression'][value]))
+            for row in ret['largest']:
+                print('  (%d,%d) %d 字节 %d 扇区' % (row['x'], row['z'], row['length'], row['sectors']))
     # }}}
 
     def run(self): # {{{
+        Profile.enabled = 'profile' in self.cfg or 'profile_json' in self.cfg
+        Profile.reset()
+        start = time.perf_counter()
+
+        profiler = None
+        if 'cprofile' in self.cfg:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            self.dispatch()
+        finally:
+            if profiler != None:
+                profiler.disable()
+                profiler.dump_stats(self.cfg['cprofile'])
+
+        wall = time.perf_counter() - start
+        if 'profile' in self.cfg:
+            Profile.report(sys.stderr, wall)
+        if 'profile_json' in self.cfg:
+            snapshot = Profile.snapshot()
+            snapshot['wall'] = wall
+            with open(self.cfg['profile_json'], 'w', encoding = 'utf-8') as f:
+                json.dump(snapshot, f, indent = 2)
+    # }}}
+
+    def do_merge(self): # {{{
+        if len(self.args) <= 0:
+            print('参数错误')
+            return
+
+        parts = []
+        regions = {}
+        for path in self.args:
+            part = CalcPartial(path)
+            if not part.load():
+                print('部分结果文件错误: %s' % path)
+                return
+            if len(parts) > 0:
+                error = parts[0].check(part)
+                if error != None:
+                    print('%s: %s' % (error, path))
+                    return
+            for file_name in part.meta['regions']:
+                if file_name in regions:
+                    print('区域文件重复: %s（%s, %s）' % (file_name, regions[file_name], path))
+                    return
+                regions[file_name] = path
+            parts.append(part)
+
+        meta = dict(parts[0].meta)
+        meta['shard'] = None
+        meta['regions'] = sorted(regions)
+        count = None
+        for part in parts:
+            count = McWorld.merge_count(count, part.count)
+        if ('grid' in self.cfg or 'top' in self.cfg) and any(not '__grid__' in part.count for part in parts):
+            print('部分结果中没有区块网格数据')
+            return
+        if ChunkGrid(meta['names'], {}).get_rule(self.cfg.get('rule')) < 0:
+            print('统计项目不存在')
+            return
+
+        if 'output' in self.cfg:
+            CalcPartial(self.cfg['output']).save(meta, count)
+        stats = count.pop('__stats__', {'files': 0, 'chunks': 0, 'bytes': 0})
+        print('部分结果: %d 区域文件: %d 区块: %d 读取: %.2fMB' % (len(parts), stats['files'], stats['chunks'], stats['bytes'] / 1048576))
+        self.print_calc({'calc': meta['calc']}, meta['names'], count)
+    # }}}
+
+    def dispatch(self): # {{{
         if self.cmd == 'nbt':
             return self.do_nbt()
         elif self.cmd == 'list':
@@ -774,6 +3448,18 @@ class App: # {{{
             return self.do_clear()
         elif self.cmd == 'calc':
             return self.do_calc_block()
+        elif self.cmd == 'histogram':
+            return self.do_histogram()
+        elif self.cmd == 'diff':
+            return self.do_diff()
+        elif self.cmd == 'compact':
+            return self.do_compact()
+        elif self.cmd == 'recompress':
+            return self.do_recompress()
+        elif self.cmd == 'index':
+            return self.do_index()
+        elif self.cmd == 'merge':
+            return self.do_merge()
         else:
             print('指令不存在')
             return
@@ -0,0 +1,356 @@
+#coding=utf-8
+
+import os, sys, time, json, getopt, tempfile, shutil, subprocess, resource, io
+import numpy
+from nbt import nbt
+from app import RegionList, NbtScanner, McChunk, McRegion, McWorld
+
+class WorldGenerator: # {{{
+
+    DEFAULT_BLOCKS = {0: 0.30, 1: 0.55, 3: 0.08, 13: 0.03, 15: 0.015, 16: 0.015, 56: 0.002, 7: 0.008}
+    BLOCK_NAMES = {0: 'minecraft:air', 1: 'minecraft:stone', 3: 'minecraft:dirt', 7: 'minecraft:bedrock', 13: 'minecraft:gravel',
+        15: 'minecraft:iron_ore', 16: 'minecraft:coal_ore', 56: 'minecraft:diamond_ore'}
+    DATA_VERSIONS = {'legacy': 1343, '1.13': 1631, '1.16': 2586, '1.18': 2975}
+
+    def __init__(self, seed = 1, regions = 1, fill = 1.0, sections = 8, blocks = None, level = 6, version = 'legacy', codec = 'zlib'): # {{{
+        self.seed = seed
+        self.regions = regions
+        self.fill = fill
+        self.sections = sections
+        self.level = level
+        self.version = version
+        self.codec = codec
+        if blocks == None:
+            blocks = WorldGenerator.DEFAULT_BLOCKS
+        keys = sorted(blocks, key = lambda i: (not str(i).isdigit(), int(i) if str(i).isdigit() else i))
+        self.weights = numpy.array([float(blocks[i]) for i in keys])
+        self.weights /= self.weights.sum()
+        self.names = []
+        for key in keys:
+            if str(key).isdigit():
+                self.names.append(WorldGenerator.BLOCK_NAMES.get(int(key), 'minecraft:block_%s' % key))
+            else:
+                self.names.append(key)
+        if version == 'legacy':
+            self.ids = numpy.array([int(i) for i in keys], dtype=numpy.uint16)
+    # }}}
+
+    @staticmethod
+    def pack_states(index, bits, padded): # {{{
+        if padded:
+            per_long = 64 // bits
+            count = (4096 + per_long - 1) // per_long
+            data = numpy.zeros(count * per_long, dtype=numpy.uint64)
+            data[:4096] = index
+            data = data.reshape(count, per_long) << (numpy.arange(per_long, dtype=numpy.uint64) * numpy.uint64(bits))
+            longs = numpy.bitwise_or.reduce(data, axis = 1)
+        else:
+            data = ((index[:, None] >> numpy.arange(bits, dtype=numpy.uint64)) & numpy.uint64(1)).astype(numpy.uint8)
+            longs = numpy.frombuffer(numpy.packbits(data.reshape(-1), bitorder = 'little').tobytes(), dtype='<u8')
+        return longs.astype(numpy.uint64).view(numpy.int64).tolist()
+    # }}}
+
+    def make_palette_section(self, rng, y): # {{{
+        index = rng.choice(len(self.names), size = 4096, p = self.weights)
+        used, index = numpy.unique(index, return_inverse = True)
+        palette = nbt.TAG_List(name = 'Palette', type = nbt.TAG_Compound)
+        for i in used.tolist():
+            item = nbt.TAG_Compound()
+            item.tags.append(nbt.TAG_String(name = 'Name', value = self.names[i]))
+            palette.tags.append(item)
+
+        states = None
+        if len(used) > 1:
+            bits = max(4, (len(used) - 1).bit_length())
+            states = nbt.TAG_Long_Array(name = 'BlockStates')
+            states.value = WorldGenerator.pack_states(index.astype(numpy.uint64), bits, self.version != '1.13')
+
+        section = nbt.TAG_Compound()
+        section.tags.append(nbt.TAG_Byte(name = 'Y', value = y))
+        if self.version == '1.18':
+            palette.name = 'palette'
+            block_states = nbt.TAG_Compound(name = 'block_states')
+            block_states.tags.append(palette)
+            if states != None:
+                states.name = 'data'
+                block_states.tags.append(states)
+            section.tags.append(block_states)
+        else:
+            section.tags.append(palette)
+            if states != None:
+                section.tags.append(states)
+        for name in ('BlockLight', 'SkyLight'):
+            tag = nbt.TAG_Byte_Array(name = name)
+            tag.value = bytearray(rng.integers(0, 256, 2048, dtype=numpy.uint8).tobytes())
+            section.tags.append(tag)
+        return section
+    # }}}
+
+    def region_coords(self): # {{{
+        side = 1
+        while side * side < self.regions:
+            side += 1
+        coords = []
+        for i in range(0, self.regions):
+            coords.append([i % side - side // 2, i // side - side // 2])
+        return coords
+    # }}}
+
+    def make_section(self, rng, y): # {{{
+        ids = rng.choice(self.ids, size = 4096, p = self.weights)
+        section = nbt.TAG_Compound()
+        section.tags.append(nbt.TAG_Byte(name = 'Y', value = y))
+        blocks = nbt.TAG_Byte_Array(name = 'Blocks')
+        blocks.value = bytearray((ids & 0xFF).astype(numpy.uint8).tobytes())
+        section.tags.append(blocks)
+        if (ids > 255).any():
+            high = (ids >> 8).astype(numpy.uint8)
+            add = nbt.TAG_Byte_Array(name = 'Add')
+            add.value = bytearray((high[0::2] | (high[1::2] << 4)).tobytes())
+            section.tags.append(add)
+        for name in ('Data', 'BlockLight', 'SkyLight'):
+            tag = nbt.TAG_Byte_Array(name = name)
+            tag.value = bytearray(rng.integers(0, 256, 2048, dtype=numpy.uint8).tobytes())
+            section.tags.append(tag)
+        return section
+    # }}}
+
+    def make_chunk(self, rng, coord): # {{{
+        nbtfile = nbt.NBTFile()
+        nbtfile.name = ''
+        nbtfile.tags.append(nbt.TAG_Int(name = 'DataVersion', value = WorldGenerator.DATA_VERSIONS[self.version]))
+
+        level = nbt.TAG_Compound(name = 'Level')
+        if self.version == '1.18':
+            level = nbtfile
+        level.tags.append(nbt.TAG_Int(name = 'xPos', value = coord[0]))
+        level.tags.append(nbt.TAG_Int(name = 'zPos', value = coord[1]))
+        level.tags.append(nbt.TAG_Long(name = 'LastUpdate', value = int(rng.integers(0, 1 << 20))))
+        level.tags.append(nbt.TAG_Long(name = 'InhabitedTime', value = int(rng.integers(0, 1 << 16))))
+        level.tags.append(nbt.TAG_Byte(name = 'TerrainPopulated', value = 1))
+
+        biomes = nbt.TAG_Byte_Array(name = 'Biomes')
+        biomes.value = bytearray(rng.integers(0, 40, 256, dtype=numpy.uint8).tobytes())
+        level.tags.append(biomes)
+        height_map = nbt.TAG_Int_Array(name = 'HeightMap')
+        height_map.value = [self.sections * 16] * 256
+        level.tags.append(height_map)
+
+        sections = nbt.TAG_List(name = 'Sections', type = nbt.TAG_Compound)
+        for y in range(0, self.sections):
+            if self.version == 'legacy':
+                sections.tags.append(self.make_section(rng, y))
+            elif self.version == '1.18':
+                sections.tags.append(self.make_palette_section(rng, y - 4))
+            else:
+                sections.tags.append(self.make_palette_section(rng, y))
+        if self.version == '1.18':
+            sections.name = 'sections'
+        level.tags.append(sections)
+        level.tags.append(nbt.TAG_List(name = 'Entities', type = nbt.TAG_Compound))
+        level.tags.append(nbt.TAG_List(name = 'TileEntities', type = nbt.TAG_Compound))
+        if level is not nbtfile:
+            nbtfile.tags.append(level)
+
+        tmp_file = io.BytesIO()
+        nbtfile.write_file(buffer = tmp_file)
+        return McChunk.encode(tmp_file.getvalue(), self.codec, self.level)
+    # }}}
+
+    def write(self, path): # {{{
+        if not os.path.exists(path):
+            os.makedirs(path)
+        rng = numpy.random.default_rng(self.seed)
+        files = []
+        for coord in self.region_coords():
+            file_name = 'r.%d.%d.mca' % (coord[0], coord[1])
+            region = McRegion(os.path.join(path, file_name), True)
+            for index in range(0, 1024):
+                if rng.random() >= self.fill:
+                    continue
+                chunk = McChunk()
+                chunk.set_info(index = index, time_stamp = 1500000000 + int(rng.integers(0, 1 << 24)))
+                chunk.set_data(self.make_chunk(rng, [coord[0] * 32 + index % 32, coord[1] * 32 + index // 32]))
+                region.add_chunk(chunk)
+            region.write()
+            region.close()
+            files.append(file_name)
+        return files
+    # }}}
+
+# }}}
+
+class Benchmark: # {{{
+
+    APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+    @staticmethod
+    def run_command(argv): # {{{
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, Benchmark.APP] + argv, stdout = subprocess.DEVNULL)
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.perf_counter() - start
+        return {
+            'argv': argv,
+            'status': proc.returncode,
+            'wall': wall,
+            'cpu': usage.ru_utime + usage.ru_stime,
+            'max_rss_kb': usage.ru_maxrss,
+        }
+    # }}}
+
+    @staticmethod
+    def rate(result, chunks, size): # {{{
+        if result['wall'] > 0:
+            result['chunks_per_s'] = chunks / result['wall']
+            result['mb_per_s'] = size / result['wall'] / 1048576
+        return result
+    # }}}
+
+    def __init__(self, path, workers = 1): # {{{
+        self.path = os.path.abspath(path)
+        self.workers = workers
+        self.files = sorted(i for i in os.listdir(self.path) if i.endswith('.mca'))
+        self.chunks = 0
+        self.size = 0
+        for file_name in self.files:
+            with McRegion(os.path.join(self.path, file_name)) as x:
+                present = x.offsets[:, 0] != 0
+                self.chunks += int(numpy.count_nonzero(present))
+                self.size += int(x.offsets[present, 1].sum()) * 4096
+    # }}}
+
+    def timed(self, func): # {{{
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        cpu = time.process_time()
+        func()
+        return {
+            'wall': time.perf_counter() - start,
+            'cpu': time.process_time() - cpu,
+            'max_rss_kb': max(rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        }
+    # }}}
+
+    def internals(self): # {{{
+        ret = {}
+        calc = {'总数': {'exclude': {0, 7}}, '钻石': {'include': {56}}}
+        args = {'calc': calc, 'rules': McChunk.compile_calc(calc)}
+        regions = [McRegion(os.path.join(self.path, i)) for i in self.files]
+        chunks = [c for x in regions for c in (x.get_chunk(index = i) for i in range(0, 1024)) if c != None]
+
+        ret['McRegion.load'] = self.timed(lambda: [x.load() for x in regions])
+        ret['McRegion.load']['regions_per_s'] = len(regions) / max(ret['McRegion.load']['wall'], 1e-9)
+        ret['decode_nbt'] = Benchmark.rate(self.timed(lambda: [McRegion.decode_nbt(McChunk.decode(c.data)) for c in chunks]), len(chunks), self.size)
+        ret['NbtScanner.sections'] = Benchmark.rate(self.timed(lambda: [NbtScanner(c.decompress()).sections() for c in chunks]), len(chunks), self.size)
+        ret['McChunk.calc_block'] = Benchmark.rate(self.timed(lambda: [c.calc_block(args) for c in chunks]), len(chunks), self.size)
+
+        region_list = RegionList()
+        region_list.add(region_list = [{'type': 'include'}, {'type': 'exclude', 'x': [0, 255], 'z': [0, 255]}], div = 16)
+        def apply():
+            for x in regions:
+                match = region_list.match(McWorld.get_file_region([x.base[0] // 32, x.base[1] // 32]))
+                match.apply(x.base, [0] * 1024)
+        ret['RegionList.apply'] = self.timed(apply)
+        ret['RegionList.apply']['regions_per_s'] = len(regions) / max(ret['RegionList.apply']['wall'], 1e-9)
+
+        del chunks
+        for x in regions:
+            x.close()
+        return ret
+    # }}}
+
+    def commands(self, tmp): # {{{
+        ret = {}
+        config = {
+            'src': self.path,
+            'dst': os.path.join(tmp, 'clear'),
+            'workers': self.workers,
+            'calc': [{'name': '总数', 'exclude': [0, 7]}, {'name': '钻石', 'include': [56]}],
+            'area': [{'type': 'include'}, {'type': 'exclude', 'x': [0, 255], 'z': [0, 255]}],
+        }
+        cfg_path = os.path.join(tmp, 'bench.json')
+        with open(cfg_path, 'w', encoding = 'utf-8') as f:
+            json.dump(config, f, ensure_ascii = False)
+
+        ret['calc'] = Benchmark.rate(Benchmark.run_command(['calc', '-C', cfg_path]), self.chunks, self.size)
+        ret['clear'] = Benchmark.rate(Benchmark.run_command(['clear', '-C', cfg_path]), self.chunks, self.size)
+        if len(self.files) > 0:
+            region = os.path.join(self.path, self.files[0])
+            ret['list'] = Benchmark.run_command(['list', '-F', region, '-O', os.path.join(tmp, 'list.txt')])
+            with McRegion(region) as x:
+                present = numpy.flatnonzero(x.offsets[:, 0] != 0)
+                base = x.base
+            if len(present) > 0:
+                coord = '%d,%d' % (base[0] + present[0] % 32, base[1] + present[0] // 32)
+                ret['nbt'] = Benchmark.run_command(['nbt', '-D', self.path, '-c', coord, '-O', os.path.join(tmp, 'nbt.txt')])
+        return ret
+    # }}}
+
+    def run(self): # {{{
+        tmp = tempfile.mkdtemp(prefix = 'mctool-bench-')
+        try:
+            return {
+                'world': {'path': self.path, 'regions': len(self.files), 'chunks': self.chunks, 'bytes': self.size},
+                'workers': self.workers,
+                'commands': self.commands(tmp),
+                'internals': self.internals(),
+            }
+        finally:
+            shutil.rmtree(tmp)
+    # }}}
+
+# }}}
+
+def print_help(): # {{{
+    print('''
+用法: python bench.py gen -O 目录 [--seed N] [--regions N] [--fill F] [--sections N] [--level N] [--blocks JSON] [--version legacy|1.13|1.16|1.18] [--codec gzip|zlib|none|lz4]
+      python bench.py run -D 目录 [-j N] [-O 结果文件]
+    ''')
+# }}}
+
+def main(): # {{{
+    if len(sys.argv) < 2:
+        return print_help()
+    cmd = sys.argv[1]
+    try:
+        opts, args = getopt.getopt(sys.argv[2:], 'D:O:j:', ['dir=', 'output=', 'workers=', 'seed=', 'regions=', 'fill=', 'sections=', 'level=', 'blocks=', 'version=', 'codec='])
+    except getopt.GetoptError as e:
+        return print_help()
+
+    cfg = {}
+    for opt, value in opts:
+        cfg[opt.lstrip('-')] = value
+
+    if cmd == 'gen' and ('O' in cfg or 'output' in cfg):
+        blocks = None
+        if 'blocks' in cfg:
+            blocks = json.loads(cfg['blocks'])
+        generator = WorldGenerator(
+            seed = int(cfg.get('seed', 1)),
+            regions = int(cfg.get('regions', 1)),
+            fill = float(cfg.get('fill', 1.0)),
+            sections = int(cfg.get('sections', 8)),
+            blocks = blocks,
+            level = int(cfg.get('level', 6)),
+            version = cfg.get('version', 'legacy'),
+            codec = cfg.get('codec', 'zlib'))
+        files = generator.write(cfg.get('O', cfg.get('output')))
+        print(json.dumps({'files': files}))
+    elif cmd == 'run' and ('D' in cfg or 'dir' in cfg):
+        bench = Benchmark(cfg.get('D', cfg.get('dir')), int(cfg.get('j', cfg.get('workers', 1))))
+        result = json.dumps(bench.run(), indent = 2, ensure_ascii = False)
+        output = cfg.get('O', cfg.get('output'))
+        if output != None:
+            with open(output, 'w', encoding = 'utf-8') as f:
+                f.write(result)
+        else:
+            print(result)
+    else:
+        print_help()
+# }}}
+
+if __name__ == '__main__': #{{{
+    main()
+#}}}
@@ -6,6 +6,6 @@ then
 else
     python3 -m venv py3env
     source py3env/bin/activate
-    pip install nbt
+    pip install nbt numpy
     deactivate
 fi